@@ -0,0 +1,191 @@
+"""
+Spec-based, non-interactive chart rendering.
+
+A chart is described by a spec (chart_spec()): the output path, a draw function
+that plots its data onto a matplotlib Axes, the data and the labels. render_charts()
+renders a list of specs with the object-oriented API (a standalone Figure per
+chart, no pyplot state and no show()), optionally in a process pool on the Agg
+backend, and skips every chart whose spec and data hash is unchanged since the
+PNG was last written.
+
+Charts use the caller's matplotlib rcParams (e.g. a seaborn theme), which are
+handed to the workers and are part of the hash. The hash of each rendered chart
+is kept in a .chart_hashes directory next to it. Draw functions must be defined
+at module level so specs can be sent to workers.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import matplotlib
+from matplotlib.figure import Figure
+
+from instrumentation import timed
+from stage_cache import function_fingerprint, update_fingerprint
+
+
+HASH_DIR_NAME = '.chart_hashes'
+
+
+def chart_spec(path, draw, data, figsize=(12, 6), title=None, xlabel=None, ylabel=None, legend=None,
+               invert_yaxis=False, tight_layout=False, savefig=None, **options):
+    """
+    Describe one chart.
+
+    draw(ax, data, **options) plots data onto ax. legend is None (leave the
+    legend as draw left it) or a dict of Axes.legend() arguments; savefig holds
+    extra Figure.savefig() arguments such as bbox_inches.
+    """
+    return {
+        'path': str(path), 'draw': draw, 'data': data, 'options': options, 'figsize': figsize,
+        'title': title, 'xlabel': xlabel, 'ylabel': ylabel, 'legend': legend,
+        'invert_yaxis': invert_yaxis, 'tight_layout': tight_layout, 'savefig': savefig or {},
+    }
+
+
+def current_rc():
+    # The caller's rcParams, without the backend (workers always render with Agg)
+    return {key: value for key, value in matplotlib.rcParams.items() if key != 'backend'}
+
+
+def spec_hash(spec, rc=None):
+    # Hash of the chart data, the labels/options, the draw function's code and the rcParams
+    digest = hashlib.sha256()
+    update_fingerprint(digest, rc)
+    update_fingerprint(digest, spec['data'])
+    update_fingerprint(digest, function_fingerprint(spec['draw']))
+    update_fingerprint(digest, {key: value for key, value in spec.items() if key not in ('data', 'draw')})
+    return digest.hexdigest()
+
+
+def _hash_path(path):
+    path = Path(path)
+    return path.parent / HASH_DIR_NAME / f'{path.name}.sha256'
+
+
+def is_up_to_date(spec, digest=None):
+    # The PNG exists and was rendered from the same spec and data
+    path = Path(spec['path'])
+    hash_path = _hash_path(path)
+    if not path.exists() or not hash_path.exists():
+        return False
+    return hash_path.read_text() == (digest or spec_hash(spec, current_rc()))
+
+
+def draw_figure(spec):
+    # Build the Figure of a spec without touching pyplot
+    fig = Figure(figsize=spec['figsize'])
+    ax = fig.subplots()
+    spec['draw'](ax, spec['data'], **spec['options'])
+    if spec['title'] is not None:
+        ax.set_title(spec['title'])
+    if spec['xlabel'] is not None:
+        ax.set_xlabel(spec['xlabel'])
+    if spec['ylabel'] is not None:
+        ax.set_ylabel(spec['ylabel'])
+    if spec['legend'] is not None:
+        ax.legend(**spec['legend'])
+    if spec['invert_yaxis']:
+        ax.invert_yaxis()
+    if spec['tight_layout']:
+        fig.tight_layout()
+    return fig
+
+
+def render_chart(spec, digest=None):
+    # Render one spec to its PNG and record its hash
+    path = Path(spec['path'])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    draw_figure(spec).savefig(path, **spec['savefig'])
+
+    hash_path = _hash_path(path)
+    hash_path.parent.mkdir(exist_ok=True)
+    hash_path.write_text(digest or spec_hash(spec, current_rc()))
+    return str(path)
+
+
+def _init_worker(rc):
+    matplotlib.use('Agg')
+    matplotlib.rcParams.update(rc)
+
+
+@timed('render_charts')
+def render_charts(specs, n_jobs=1, force=False):
+    """
+    Render every chart whose PNG is missing or out of date.
+
+    With n_jobs > 1 (or -1 for every core) the charts are rendered in a process
+    pool on the Agg backend. force=True re-renders unchanged charts too.
+    Returns {path: 'rendered' or 'skipped'} in spec order.
+    """
+    rc = current_rc()
+    digests = [spec_hash(spec, rc) for spec in specs]
+    pending = [(spec, digest) for spec, digest in zip(specs, digests) if force or not is_up_to_date(spec, digest)]
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs <= 1 or len(pending) <= 1:
+        for spec, digest in pending:
+            render_chart(spec, digest)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(pending)), initializer=_init_worker,
+                                 initargs=(rc,)) as executor:
+            list(executor.map(render_chart, *zip(*pending)))
+
+    rendered = {spec['path'] for spec, _ in pending}
+    return {spec['path']: 'rendered' if spec['path'] in rendered else 'skipped' for spec in specs}
+
+
+def draw_heatmap(ax, data, **options):
+    # seaborn heatmap of a table
+    import seaborn as sns
+    sns.heatmap(data, ax=ax, **options)
+
+
+def draw_histogram(ax, data, **options):
+    import seaborn as sns
+    sns.histplot(data, ax=ax, **options)
+
+
+def draw_pandas(ax, data, kind='line', **options):
+    # DataFrame.plot / Series.plot onto ax
+    data.plot(kind=kind, ax=ax, **options)
+
+
+def draw_line(ax, data, **options):
+    # Plain line of a Series against its index
+    ax.plot(data.index, data.to_numpy(), **options)
+
+
+def draw_labelled_scatter(ax, data, x, y, markers, size=100):
+    # Scatter of data[x] against data[y] with one marker and legend entry per row
+    ax.scatter(data[x], data[y])
+    for i, (label, row) in enumerate(data.iterrows()):
+        ax.scatter(row[x], row[y], label=label, marker=markers[i % len(markers)], s=size)
+
+
+def draw_pandas_layers(ax, data, kind='line', styles=()):
+    # Several Series plotted onto the same ax, each with its own plot() arguments
+    for series, style in zip(data, styles):
+        series.plot(kind=kind, ax=ax, **style)
+
+
+def draw_lines(ax, data, grid=False, date_format=None, rotation=0):
+    # One line per DataFrame column against its (datetime) index, optionally with formatted date ticks
+    for label, column in data.items():
+        ax.plot(data.index, column.to_numpy(), label=label)
+    ax.grid(grid)
+    if date_format is not None:
+        ax.set_xticks(data.index, data.index.strftime(date_format), rotation=rotation)
+
+
+def draw_table(ax, data, fontsize=10, scale=(1.2, 1.2)):
+    # Rows of cell text drawn as a table, without axes
+    ax.axis('tight')
+    ax.axis('off')
+    table = ax.table(cellText=data, colLabels=None, cellLoc='center', loc='center')
+    table.auto_set_font_size(False)
+    table.set_fontsize(fontsize)
+    table.scale(*scale)
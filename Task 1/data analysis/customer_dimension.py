@@ -0,0 +1,107 @@
+"""
+Customer dimension keyed by loyalty card.
+
+QVI_purchase_behaviour.csv is cleaned once (dropna, first row per card) into a
+CustomerDimension: the loyalty card numbers plus LIFESTAGE and
+PREMIUM_CUSTOMER as small integer codes. Attaching the segment labels to
+transactions is then an array lookup per row instead of a pd.merge that
+re-hashes and copies the whole transaction table. Lookups only need the
+LYLTY_CARD_NBR column, so they work the same on a full table or chunk by chunk.
+"""
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+
+
+SEGMENT_COLUMNS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+# A dense card -> row table is used while the card number range is at most this
+# many times the number of customers (the QVI cards span ~33x); wider ranges
+# fall back to binary search on the sorted cards
+DENSE_SPAN_LIMIT = 64
+
+
+def clean_behaviour(behav):
+    # Drop incomplete customers and keep the first row of every loyalty card, as Part 1 does
+    return behav.dropna().drop_duplicates(subset='LYLTY_CARD_NBR', keep='first')
+
+
+class CustomerDimension:
+    """
+    Segment codes per loyalty card, built once from the cleaned behaviour table.
+
+    cards holds the sorted loyalty card numbers, codes[column] the category
+    code of each card and categories[column] the category labels.
+    """
+
+    def __init__(self, behav, columns=SEGMENT_COLUMNS):
+        cards = behav['LYLTY_CARD_NBR'].to_numpy(dtype=np.int64)
+        order = np.argsort(cards, kind='stable')
+        self.cards = cards[order]
+        if len(self.cards) > 1 and (self.cards[1:] == self.cards[:-1]).any():
+            raise ValueError('Loyalty card numbers must be unique; clean the behaviour table with clean_behaviour()')
+
+        self.columns = list(columns)
+        self.codes, self.categories = {}, {}
+        for column in self.columns:
+            labels = pd.Categorical(behav[column])
+            self.codes[column] = labels.codes[order]
+            self.categories[column] = labels.categories
+
+        # Dense card -> row table when the card numbers are compact enough
+        self._offset = int(self.cards[0]) if len(self.cards) else 0
+        span = int(self.cards[-1]) - self._offset + 1 if len(self.cards) else 0
+        self._dense = None
+        if span <= DENSE_SPAN_LIMIT * max(len(self.cards), 1):
+            self._dense = np.full(span, -1, dtype=np.int32 if len(self.cards) < 2 ** 31 else np.int64)
+            self._dense[self.cards - self._offset] = np.arange(len(self.cards))
+
+    @classmethod
+    def from_csv(cls, path, columns=SEGMENT_COLUMNS):
+        # Read and clean QVI_purchase_behaviour.csv
+        return cls(clean_behaviour(pd.read_csv(path)), columns)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def rows_for(self, cards):
+        # Dimension row of each loyalty card, -1 for cards that are not in the dimension
+        cards = np.asarray(cards, dtype=np.int64)
+        if self._dense is not None:
+            positions = cards - self._offset
+            inside = (positions >= 0) & (positions < len(self._dense))
+            rows = np.full(len(cards), -1, dtype=self._dense.dtype)
+            rows[inside] = self._dense[positions[inside]]
+            return rows
+
+        rows = np.searchsorted(self.cards, cards)
+        found = rows < len(self.cards)
+        found[found] = self.cards[rows[found]] == cards[found]
+        return np.where(found, rows, -1)
+
+    def segment_codes(self, cards, column):
+        # Category codes of one dimension column for each loyalty card (-1 when unknown)
+        rows = self.rows_for(cards)
+        return np.where(rows >= 0, self.codes[column][rows], -1)
+
+    def segment(self, cards, column):
+        # One dimension column as a Categorical sharing the dimension's categories
+        return pd.Categorical.from_codes(self.segment_codes(cards, column), self.categories[column])
+
+    @timed('attach_customers')
+    def attach(self, transactions, columns=None):
+        """
+        Add the customer columns to a transaction frame (a full table or a chunk).
+
+        Same rows and labels as pd.merge(transactions, behav, on='LYLTY_CARD_NBR',
+        how='left', validate='m:1'): unknown cards get NaN. The labels are
+        categoricals and the transaction columns are not copied.
+        """
+        rows = self.rows_for(transactions['LYLTY_CARD_NBR'].to_numpy())
+        attached = transactions.copy(deep=False)
+        for column in columns or self.columns:
+            codes = np.where(rows >= 0, self.codes[column][rows], -1)
+            attached[column] = pd.Categorical.from_codes(codes, self.categories[column])
+        return attached
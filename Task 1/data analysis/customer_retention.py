@@ -0,0 +1,180 @@
+"""
+Customer retention from per-customer month bitsets.
+
+One pass over the transactions sets bit i of a loyalty card's mask when the
+card bought anything in the i-th month of the history. Retention questions are
+then bitwise operations over one small integer row per customer instead of
+date arithmetic and set intersections over every transaction:
+
+    activity = CustomerActivity.from_transactions(merged_df)
+    activity.retained(lag=1)                 # customers of month m who buy again in m + 1
+    activity.retention_rate(lag=3)           # share of them who buy again three months later
+    activity.cohort_matrix(by='LIFESTAGE')   # cohorts by first month, per segment
+
+Masks are arrays of uint64 words, 64 months per word, so any history length works.
+"""
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+
+
+SEGMENT_COLUMNS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+WORD_BITS = 64
+
+
+def _month_periods(transactions):
+    # Monthly periods of the rows as (codes, distinct periods), one conversion per distinct month
+    if 'MONTH_YEAR' in transactions:
+        codes, labels = pd.factorize(transactions['MONTH_YEAR'])
+        periods = pd.PeriodIndex([str(label) for label in labels], freq='M')
+    else:
+        codes, periods = pd.factorize(transactions['DATE'].dt.to_period('M'))
+        periods = pd.PeriodIndex(periods, freq='M')
+    return codes, periods
+
+
+class CustomerActivity:
+    """
+    Active months of every loyalty card as a bitset.
+
+    cards are the sorted loyalty card numbers, months the consecutive monthly
+    periods from the first to the last month with a transaction (months
+    without any transaction keep their bit position), masks an
+    (n_cards, n_words) uint64 array and segments the segment labels of each
+    card (when the transactions have them).
+    """
+
+    def __init__(self, cards, months, masks, segments=None):
+        self.cards = cards
+        self.months = months
+        self.masks = masks
+        self.segments = segments or {}
+
+    @classmethod
+    @timed('customer_activity')
+    def from_transactions(cls, transactions, segment_columns=SEGMENT_COLUMNS):
+        # Build the month masks (and each card's segment) in one pass over the rows
+        card_codes, cards = pd.factorize(transactions['LYLTY_CARD_NBR'], sort=True)
+        month_codes, periods = _month_periods(transactions)
+
+        first = periods.min()
+        months = pd.period_range(first, periods.max(), freq='M', name='MONTH_YEAR')
+        positions = (np.asarray(periods.asi8) - first.ordinal)[month_codes]
+
+        masks = np.zeros((len(cards), (len(months) + WORD_BITS - 1) // WORD_BITS), dtype=np.uint64)
+        bits = np.left_shift(np.uint64(1), (positions % WORD_BITS).astype(np.uint64))
+        for word in range(masks.shape[1]):
+            in_word = positions // WORD_BITS == word
+            np.bitwise_or.at(masks[:, word], card_codes[in_word], bits[in_word])
+
+        # A card has a single segment, so the label of any of its rows will do
+        segments = {}
+        first_rows = np.full(len(cards), -1, dtype=np.int64)
+        first_rows[card_codes[::-1]] = np.arange(len(card_codes))[::-1]
+        for column in segment_columns:
+            if column in transactions:
+                segments[column] = transactions[column].iloc[first_rows].reset_index(drop=True)
+        return cls(np.asarray(cards), months, masks, segments)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def active(self, month):
+        # Boolean per card: did it buy in the month at position month?
+        if month < 0 or month >= len(self.months):
+            return np.zeros(len(self.cards), dtype=bool)
+        word, bit = divmod(month, WORD_BITS)
+        return (self.masks[:, word] >> np.uint64(bit)) & np.uint64(1) == 1
+
+    def active_at(self, positions):
+        # Boolean per card: did card i buy in the month at positions[i]?
+        positions = np.asarray(positions)
+        inside = (positions >= 0) & (positions < len(self.months))
+        safe = np.where(inside, positions, 0)
+        words = self.masks[np.arange(len(self.cards)), safe // WORD_BITS]
+        return inside & ((words >> (safe % WORD_BITS).astype(np.uint64)) & np.uint64(1) == 1)
+
+    def first_month(self):
+        # Position of each card's first active month
+        first = np.full(len(self.cards), -1, dtype=np.int64)
+        for word in range(self.masks.shape[1] - 1, -1, -1):
+            values = self.masks[:, word]
+            nonzero = values != 0
+            # The lowest set bit of x is x & -x, a power of two whose log2 is its position
+            lowest = values[nonzero] & (~values[nonzero] + np.uint64(1))
+            first[nonzero] = word * WORD_BITS + np.log2(lowest.astype(np.float64)).astype(np.int64)
+        return first
+
+    def active_customers(self):
+        # Number of active customers per month
+        return pd.Series([int(self.active(month).sum()) for month in range(len(self.months))],
+                         index=self.months, name='active_customers')
+
+    def retained(self, lag=1):
+        """
+        Customers of each month who buy again lag months later.
+
+        With lag=1 this is month-over-month retention; the last lag months
+        have no later month in the data and count 0.
+        """
+        counts = [int((self.active(month) & self.active(month + lag)).sum()) for month in range(len(self.months))]
+        return pd.Series(counts, index=self.months, name='retained_customers')
+
+    def retention_rate(self, lag=1, by=None):
+        """
+        Share of each month's customers who buy again lag months later.
+
+        by names a segment column to get one column per segment value.
+        Months without a later month in the data are NaN.
+        """
+        later = np.arange(len(self.months)) + lag < len(self.months)
+        if by is None:
+            rate = self.retained(lag) / self.active_customers()
+            return rate.where(later).rename('retention_rate')
+
+        codes, values = pd.factorize(self.segments[by], sort=True)
+        columns = {}
+        for month in range(len(self.months)):
+            # Cards without a segment label (code -1) are left out
+            active = self.active(month) & (codes >= 0)
+            kept = active & self.active(month + lag)
+            columns[self.months[month]] = (
+                np.bincount(codes[kept], minlength=len(values)) / np.bincount(codes[active], minlength=len(values))
+            )
+        rate = pd.DataFrame(columns, index=pd.Index(values, name=by)).T
+        rate.index.name = 'MONTH_YEAR'
+        rate.iloc[~later] = np.nan
+        return rate
+
+    def cohort_matrix(self, by=None, normalize=True):
+        """
+        Customers by first month (cohort) and months since it.
+
+        Rows are cohorts (per segment value when by names a segment column),
+        columns the month offset 0, 1, 2, ...; normalize=True divides by the
+        cohort size, so offset 0 is 1.0. Offsets past the end of the data are NaN.
+        """
+        first = self.first_month()
+        n_months = len(self.months)
+        if by is None:
+            keys, key_index = first, pd.Index(self.months, name='cohort')
+            n_keys = n_months
+        else:
+            codes, values = pd.factorize(self.segments[by], sort=True)
+            # Cards without a segment label get a key past the end and are dropped by bincount's slice below
+            keys = np.where(codes >= 0, codes * n_months + first, len(values) * n_months)
+            key_index = pd.MultiIndex.from_product([values, self.months], names=[by, 'cohort'])
+            n_keys = len(values) * n_months
+
+        counts = np.empty((n_keys, n_months))
+        for offset in range(n_months):
+            counts[:, offset] = np.bincount(keys, weights=self.active_at(first + offset), minlength=n_keys + 1)[:n_keys]
+
+        matrix = pd.DataFrame(counts, index=key_index, columns=pd.RangeIndex(n_months, name='months_since_first'))
+        cohort_positions = np.tile(np.arange(n_months), n_keys // n_months)
+        matrix = matrix.where(cohort_positions[:, None] + np.arange(n_months)[None, :] < n_months)
+        matrix = matrix[matrix[0] > 0]
+        return matrix.div(matrix[0], axis=0) if normalize else matrix
@@ -0,0 +1,206 @@
+"""
+Per-stage timing and profiling for the analysis pipeline.
+
+Stages are marked with the stage() context manager or the @timed decorator.
+While instrumentation is enabled each stage records its wall and CPU time,
+rows in and out, RSS change and peak RSS, and optionally a cProfile dump.
+When it is disabled (the default) a stage costs one attribute check.
+
+    import instrumentation
+    instrumentation.enable(profile_dir='profiles')     # or QVI_INSTRUMENT=1 in the environment
+
+    with instrumentation.stage('merge', rows_in=len(transac)) as merge_stage:
+        merged = pd.merge(transac, behav, on='LYLTY_CARD_NBR')
+        merge_stage.rows_out = len(merged)
+
+    instrumentation.write_report('run_report.json')
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pandas as pd
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its RSS high-water mark; elsewhere the peak only grows
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _proc_status_mb(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    peak = _proc_status_mb('VmHWM:')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    return peak
+
+
+def rss_mb():
+    # Current resident set size (the peak where the current value is not available)
+    current = _proc_status_mb('VmRSS:')
+    return peak_rss_mb() if current is None else current
+
+
+class _Stage:
+    # Handed out by stage(); callers may set rows_in / rows_out on it
+    __slots__ = ('rows_in', 'rows_out')
+
+    def __init__(self, rows_in=None):
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+class StageRecorder:
+    """
+    Collects the stage records of one run.
+
+    Stages can be nested; the peak RSS and cProfile dump are taken for the
+    outermost stage only (an inner stage reports the peak since its outer
+    stage started). Stages run inside worker processes are not recorded.
+    """
+
+    def __init__(self, enabled=False, profile_dir=None):
+        self.enabled = enabled
+        self.profile_dir = None if profile_dir is None else Path(profile_dir)
+        self.records = []
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        if not self.enabled:
+            yield _Stage(rows_in)
+            return
+
+        current = _Stage(rows_in)
+        outermost = self._depth == 0
+        profiler = cProfile.Profile() if outermost and self.profile_dir is not None else None
+        if outermost:
+            reset_peak_rss()
+        rss_before = rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        self._depth += 1
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield current
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._depth -= 1
+            record = {
+                'stage': name,
+                'depth': self._depth,
+                'wall_s': time.perf_counter() - wall_start,
+                'cpu_s': time.process_time() - cpu_start,
+                'rows_in': current.rows_in,
+                'rows_out': current.rows_out,
+                'rss_delta_mb': rss_mb() - rss_before,
+                'peak_rss_mb': peak_rss_mb(),
+            }
+            if profiler is not None:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profile_path = self.profile_dir / f'{len(self.records):03d}_{name}.prof'
+                profiler.dump_stats(profile_path)
+                record['profile'] = str(profile_path)
+            self.records.append(record)
+
+    def report(self):
+        # Machine-readable summary of the run: every stage record plus per-stage totals
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+        return {
+            'started_at': self.started_at,
+            'pid': os.getpid(),
+            'stages': self.records,
+            'totals': totals,
+            'total_wall_s': sum(record['wall_s'] for record in self.records if record['depth'] == 0),
+        }
+
+    def write_report(self, path):
+        Path(path).write_text(json.dumps(self.report(), indent=2, default=str) + '\n')
+        return path
+
+
+# Process-wide recorder used by stage(), timed() and the module functions below
+recorder = StageRecorder(enabled=os.environ.get('QVI_INSTRUMENT', '') not in ('', '0'),
+                         profile_dir=os.environ.get('QVI_PROFILE_DIR') or None)
+
+
+def enable(profile_dir=None):
+    # Start recording stages (and dump a cProfile file per outermost stage if profile_dir is set)
+    recorder.enabled = True
+    if profile_dir is not None:
+        recorder.profile_dir = Path(profile_dir)
+
+
+def disable():
+    recorder.enabled = False
+
+
+def stage(name, rows_in=None):
+    return recorder.stage(name, rows_in)
+
+
+def _rows(value):
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+def timed(name):
+    """
+    Decorator recording every call of a function as stage name.
+
+    rows_in is the length of the first DataFrame/Series argument and rows_out
+    the length of a DataFrame/Series result.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not recorder.enabled:
+                return function(*args, **kwargs)
+            rows_in = next((_rows(arg) for arg in args if _rows(arg) is not None), None)
+            with recorder.stage(name, rows_in) as current:
+                result = function(*args, **kwargs)
+                current.rows_out = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def report():
+    return recorder.report()
+
+
+def write_report(path):
+    # Write the JSON run report; does nothing while instrumentation is disabled
+    if not recorder.enabled:
+        return None
+    return recorder.write_report(path)
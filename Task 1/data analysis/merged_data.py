@@ -0,0 +1,120 @@
+"""
+Reading and writing MergedData.csv with a typed columnar cache.
+
+write_merged_data() writes the CSV plus a Parquet copy next to it that keeps
+categorical and narrow integer dtypes. read_merged_data() loads the Parquet copy
+whenever it is newer than the CSV (optionally reading only some columns) and
+falls back to parsing the CSV otherwise.
+"""
+
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+from instrumentation import timed
+
+
+# Typed schema of the merged dataset. Store, product and pack size numbers fit in
+# int16, loyalty cards and transaction ids in int32.
+MERGED_DTYPES = {
+    'STORE_NBR': 'int16',
+    'LYLTY_CARD_NBR': 'int32',
+    'TXN_ID': 'int32',
+    'PROD_NBR': 'int16',
+    'PROD_QTY': 'int16',
+    'TOT_SALES': 'float64',
+    'PACK_SIZE (in grams)': 'int16',
+    'YEAR': 'int16',
+    'BRAND': 'category',
+    'MONTH_YEAR': 'category',
+    'MONTH_NAME': 'category',
+    'LIFESTAGE': 'category',
+    'PREMIUM_CUSTOMER': 'category',
+    'PROD_NAME': 'category',
+}
+
+# Compact in-memory layout: the typed schema with sales narrowed to float32.
+# Sums over float32 sales come back as float32 (about 7 significant digits).
+COMPACT_DTYPES = {**MERGED_DTYPES, 'TOT_SALES': 'float32'}
+
+
+def cache_path_for(csv_path):
+    # The columnar cache lives next to the CSV with a .parquet suffix
+    return Path(csv_path).with_suffix('.parquet')
+
+
+def apply_merged_schema(merged, dtypes=MERGED_DTYPES):
+    """
+    Cast the columns of a merged frame to MERGED_DTYPES (or COMPACT_DTYPES).
+
+    MONTH_YEAR is stored as 'YYYY-MM' text categories (the same text the CSV
+    holds) and DATE as datetime64. Columns that are not present are skipped.
+    """
+    merged = merged.copy()
+    if 'DATE' in merged:
+        merged['DATE'] = pd.to_datetime(merged['DATE'])
+    if 'MONTH_YEAR' in merged and not isinstance(merged['MONTH_YEAR'].dtype, pd.CategoricalDtype):
+        merged['MONTH_YEAR'] = merged['MONTH_YEAR'].astype(str)
+    return merged.astype({column: dtype for column, dtype in dtypes.items() if column in merged})
+
+
+def _has_parquet_engine():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def write_merged_cache(merged, csv_path):
+    # Write only the typed Parquet copy of an already exported CSV
+    if not _has_parquet_engine():
+        warnings.warn('pyarrow is not installed, skipping the MergedData Parquet cache')
+        return None
+    path = cache_path_for(csv_path)
+    apply_merged_schema(merged).to_parquet(path, index=False)
+    return path
+
+
+@timed('write_merged_data')
+def write_merged_data(merged, csv_path):
+    # Export the merged dataset as CSV and refresh its typed columnar cache
+    merged.to_csv(csv_path, index=False)
+    write_merged_cache(merged, csv_path)
+
+
+def cache_is_fresh(csv_path):
+    # The cache can be used when it exists and is at least as new as the CSV
+    cache_path = cache_path_for(csv_path)
+    if not cache_path.exists():
+        return False
+    csv_path = Path(csv_path)
+    return not csv_path.exists() or cache_path.stat().st_mtime >= csv_path.stat().st_mtime
+
+
+@timed('read_merged_data')
+def read_merged_data(csv_path, columns=None, refresh_cache=True, compact=False):
+    """
+    Load the merged dataset, preferring the Parquet cache when it is fresh.
+
+    columns limits the load to those columns (read directly from the cache
+    without touching the others). When the cache is missing or older than the
+    CSV, the CSV is parsed with the typed schema and, if refresh_cache is set,
+    the cache is rewritten so the next run can use it.
+    compact=True returns the COMPACT_DTYPES layout (float32 sales) for the
+    lowest memory use and fastest groupby/pivot_table calls.
+    """
+    if cache_is_fresh(csv_path) and _has_parquet_engine():
+        merged = pd.read_parquet(cache_path_for(csv_path), columns=columns)
+    elif refresh_cache and _has_parquet_engine():
+        merged = apply_merged_schema(pd.read_csv(csv_path))
+        merged.to_parquet(cache_path_for(csv_path), index=False)
+        if columns is not None:
+            merged = merged[columns]
+    else:
+        merged = apply_merged_schema(pd.read_csv(csv_path, usecols=columns))
+        if columns is not None:
+            merged = merged[columns]
+
+    return apply_merged_schema(merged, COMPACT_DTYPES) if compact else merged
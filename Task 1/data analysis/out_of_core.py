@@ -0,0 +1,194 @@
+"""
+Out-of-core run of the Part 1 cleaning pipeline.
+
+The transactions never have to fit in memory at once:
+
+1. partition_transactions() streams the workbook (or its CSV export) in
+   chunks, applies the row-level cleaning (dates, non-chip filter, PROD_QTY ==
+   200 outlier) and spills every chunk's rows to one directory per month:
+
+       <work_dir>/MONTH_YEAR=2018-07/part-00000.pkl
+
+2. build_month_partition() loads one month, drops duplicate rows (exact
+   duplicates share their DATE, so they always land in the same month), adds
+   the brand, pack size and date columns, sorts by DATE and attaches the
+   customer segments from a CustomerDimension. Months are independent and can
+   be built in a process pool.
+
+3. write_merged_partitions() appends the months in order to MergedData.csv
+   and its typed Parquet cache, with the same categories a single in-memory
+   write would give.
+
+Memory is bounded by the largest month plus the (small) customer dimension.
+The output has the same rows, columns and dtypes as the in-memory notebook; rows
+that share a DATE stay in input order (the notebook's unstable sort leaves
+their order arbitrary).
+"""
+
+import os
+import shutil
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from customer_dimension import CustomerDimension
+from instrumentation import timed
+from merged_data import MERGED_DTYPES, _has_parquet_engine, apply_merged_schema, cache_path_for
+from product_parser import attach_product_attributes
+from transaction_ingest import DEFAULT_CHUNKSIZE, clean_transaction_chunk, iter_transaction_chunks
+
+
+PARTITION_PREFIX = 'MONTH_YEAR='
+
+# Input position of every row, so duplicates keep their first occurrence and
+# rows of the same day keep their input order
+ROW_COLUMN = '_ROW'
+
+CATEGORY_COLUMNS = [column for column, dtype in MERGED_DTYPES.items() if dtype == 'category']
+
+
+def partition_dir_for(work_dir, month):
+    return Path(work_dir) / f'{PARTITION_PREFIX}{month}'
+
+
+def partition_months(work_dir):
+    # Months spilled to work_dir, in calendar order
+    return sorted(path.name[len(PARTITION_PREFIX):] for path in Path(work_dir).glob(f'{PARTITION_PREFIX}*'))
+
+
+@timed('partition_transactions')
+def partition_transactions(path, work_dir, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Stream and clean the raw transactions into per-month spill files.
+
+    Returns the months written, in calendar order.
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    next_row = 0
+    for number, chunk in enumerate(iter_transaction_chunks(path, chunksize)):
+        chunk = chunk.copy()
+        chunk[ROW_COLUMN] = range(next_row, next_row + len(chunk))
+        next_row += len(chunk)
+
+        chunk = clean_transaction_chunk(chunk)
+        months = chunk['DATE'].dt.strftime('%Y-%m')
+        for month, rows in chunk.groupby(months, sort=False):
+            month_dir = partition_dir_for(work_dir, month)
+            month_dir.mkdir(exist_ok=True)
+            rows.to_pickle(month_dir / f'part-{number:05d}.pkl')
+    return partition_months(work_dir)
+
+
+def build_month_partition(month_dir, customers):
+    """
+    Turn the spilled chunks of one month into its rows of MergedData.
+
+    Writes <month_dir>/merged.pkl and returns the categories of its
+    categorical columns, so the months can be written with shared categories.
+    """
+    month_dir = Path(month_dir)
+    transac = pd.concat(
+        [pd.read_pickle(part) for part in sorted(month_dir.glob('part-*.pkl'))], ignore_index=True
+    ).sort_values(ROW_COLUMN, kind='stable')
+
+    # Remove duplicates, keeping the first occurrence
+    data_columns = [column for column in transac.columns if column != ROW_COLUMN]
+    transac = transac[~transac.duplicated(subset=data_columns)]
+
+    transac = attach_product_attributes(transac)
+    transac['MONTH_YEAR'] = transac['DATE'].dt.to_period('M')
+    transac['YEAR'] = transac['DATE'].dt.year
+    transac['MONTH_NAME'] = transac['DATE'].dt.month_name()
+
+    # The input order breaks ties between rows of the same day
+    transac = transac.sort_values(['DATE', ROW_COLUMN], kind='stable').drop(columns=ROW_COLUMN)
+    merged = customers.attach(transac.reset_index(drop=True))
+    merged.to_pickle(month_dir / 'merged.pkl')
+
+    typed = apply_merged_schema(merged[[column for column in CATEGORY_COLUMNS if column in merged]])
+    return {column: typed[column].cat.categories.tolist() for column in typed}
+
+
+def build_month_partitions(work_dir, customers, n_jobs=1):
+    """
+    Build every spilled month, in a process pool when n_jobs > 1 (-1 for every core).
+
+    Returns the union of the categories of all months, sorted like astype('category').
+    """
+    month_dirs = [partition_dir_for(work_dir, month) for month in partition_months(work_dir)]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs <= 1 or len(month_dirs) <= 1:
+        month_categories = [build_month_partition(month_dir, customers) for month_dir in month_dirs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(month_dirs))) as executor:
+            month_categories = list(executor.map(build_month_partition, month_dirs, [customers] * len(month_dirs)))
+
+    categories = {}
+    for found in month_categories:
+        for column, values in found.items():
+            categories.setdefault(column, set()).update(values)
+    return {column: sorted(values) for column, values in categories.items()}
+
+
+@timed('write_merged_partitions')
+def write_merged_partitions(work_dir, csv_path, categories):
+    """
+    Append the built months in order to MergedData.csv and its Parquet cache.
+
+    Each month is cast to MERGED_DTYPES with the shared categories, so the
+    Parquet file reads back exactly like write_merged_cache() of the full frame.
+    Returns the number of rows written.
+    """
+    dtypes = {**MERGED_DTYPES, **{column: pd.CategoricalDtype(values) for column, values in categories.items()}}
+    writer = None
+    if _has_parquet_engine():
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    else:
+        warnings.warn('pyarrow is not installed, skipping the MergedData Parquet cache')
+
+    rows = 0
+    try:
+        for number, month in enumerate(partition_months(work_dir)):
+            merged = pd.read_pickle(partition_dir_for(work_dir, month) / 'merged.pkl')
+            merged.to_csv(csv_path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+            rows += len(merged)
+
+            if _has_parquet_engine():
+                table = pa.Table.from_pandas(apply_merged_schema(merged, dtypes), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(cache_path_for(csv_path), table.schema)
+                writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+@timed('out_of_core')
+def run_out_of_core(transactions_path, behaviour_path, csv_path, work_dir=None, chunksize=DEFAULT_CHUNKSIZE,
+                    n_jobs=1, keep_partitions=False):
+    """
+    Produce MergedData.csv (and its Parquet cache) from the raw files out of core.
+
+    work_dir holds the month partitions (default: a MergedData_partitions
+    directory next to csv_path) and is deleted afterwards unless
+    keep_partitions is set. Returns the number of rows written.
+    """
+    csv_path = Path(csv_path)
+    work_dir = Path(work_dir) if work_dir is not None else csv_path.with_name(f'{csv_path.stem}_partitions')
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+
+    customers = CustomerDimension.from_csv(behaviour_path)
+    try:
+        partition_transactions(transactions_path, work_dir, chunksize)
+        categories = build_month_partitions(work_dir, customers, n_jobs)
+        return write_merged_partitions(work_dir, csv_path, categories)
+    finally:
+        if not keep_partitions:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,106 @@
+"""
+Product dimension parser.
+
+There are only ~114 distinct PROD_NAME values against millions of transaction
+rows, so every product attribute (brand, pack size, flavour, chip or not) is
+parsed once per distinct name into a small lookup table and joined back onto
+the transactions by integer code.
+"""
+
+import re
+
+import pandas as pd
+
+from instrumentation import timed
+
+
+# Words in PROD_NAME that mark products which are not chips
+NON_CHIP_WORDS = ['salsa', 'dips', 'crackers', 'popcorn']
+
+# Combine same brands with different names
+BRAND_MAPPING = {
+    'Red': 'RRD',  # Red Rock Deli
+    'Dorito': 'Doritos',
+    'Smith': 'Smiths',
+    'Snbts': 'Sunbites',
+    'Infzns': 'Infuzions',
+    'GrnWves': 'Grain Waves',
+    'Natural': 'Natural Chip Co',
+    'French': 'French Fries'
+}
+
+PACK_SIZE_PATTERN = re.compile(r'(\d+)[gG]')
+NON_CHIP_PATTERN = re.compile('|'.join(NON_CHIP_WORDS))
+
+PRODUCT_COLUMNS = ['BRAND', 'PACK_SIZE (in grams)', 'FLAVOUR', 'IS_CHIP']
+
+
+def parse_product_name(prod_name, brand_mapping=BRAND_MAPPING):
+    """
+    Parse one product name into its attributes.
+
+    BRAND is the first word (mapped through brand_mapping), the pack size the
+    first number followed by g/G, FLAVOUR the words between the brand and the
+    pack size, and IS_CHIP is False for salsa, dips, crackers and popcorn.
+    """
+    words = prod_name.split()
+    brand = words[0] if words else None
+    pack_size = PACK_SIZE_PATTERN.search(prod_name)
+
+    # Same tokens as split(' ')[1:] without the last (pack size) word
+    flavour = ' '.join(prod_name.split(' ')[1:][:-1])
+
+    return {
+        'BRAND': brand_mapping.get(brand, brand),
+        'PACK_SIZE (in grams)': pack_size.group(1) if pack_size else None,
+        'FLAVOUR': flavour,
+        'IS_CHIP': NON_CHIP_PATTERN.search(prod_name.lower()) is None,
+    }
+
+
+def build_product_dimension(prod_names, brand_mapping=BRAND_MAPPING):
+    """
+    Factorize a PROD_NAME column and parse each distinct name once.
+
+    Returns (codes, products): an integer code per row and a lookup table with
+    one row per distinct name (in code order) and PRODUCT_COLUMNS. Categorical
+    input reuses its existing codes, so no string is hashed at all.
+    """
+    if isinstance(prod_names.dtype, pd.CategoricalDtype):
+        codes, names = prod_names.cat.codes.to_numpy(), prod_names.cat.categories
+    else:
+        codes, names = pd.factorize(prod_names)
+
+    products = pd.DataFrame(
+        [parse_product_name(name, brand_mapping) for name in names], columns=PRODUCT_COLUMNS,
+        index=pd.Index(names, name='PROD_NAME'),
+    )
+    return codes, products
+
+
+def _take(products, column, codes):
+    # Look attribute values up by code; rows without a product name (code -1) get
+    # None, except IS_CHIP which keeps them like str.contains(..., na=False) did
+    values = products[column].to_numpy()[codes]
+    missing = codes < 0
+    if missing.any():
+        values = values.astype(object)
+        values[missing] = True if column == 'IS_CHIP' else None
+    return values
+
+
+@timed('parse_products')
+def product_attribute(prod_names, column, brand_mapping=BRAND_MAPPING):
+    # One product attribute per row, looked up by code from the parsed product table
+    codes, products = build_product_dimension(prod_names, brand_mapping)
+    return pd.Series(_take(products, column, codes), index=prod_names.index, name=column)
+
+
+@timed('parse_products')
+def attach_product_attributes(transactions, columns=('BRAND', 'PACK_SIZE (in grams)'), brand_mapping=BRAND_MAPPING):
+    # Add product attributes to a transaction frame with a single parse of its product names
+    codes, products = build_product_dimension(transactions['PROD_NAME'], brand_mapping)
+    transactions = transactions.copy()
+    for column in columns:
+        transactions[column] = _take(products, column, codes)
+    return transactions
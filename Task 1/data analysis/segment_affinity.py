@@ -0,0 +1,257 @@
+"""
+Brand and pack size affinity of customer segments, and frequent itemsets.
+
+PurchaseMatrix.from_transactions() reads the transactions once into two sparse
+matrices over one product column (BRAND, pack size, ...):
+
+- loyalty card x item, holding the PROD_QTY each customer bought,
+- basket x item, marking the items of every basket (the rows of one TXN_ID
+  of one loyalty card).
+
+Every segment is then compared with the rest of the population through one
+segment x card indicator product, and frequent itemsets are mined over the
+basket matrix a-priori style:
+
+    brands = PurchaseMatrix.from_transactions(merged_df, 'BRAND')
+    brands.segment_affinity()                      # support and lift of every brand, all segments
+    brands.frequent_itemsets(min_support=0.001)    # itemsets bought together, optionally per segment
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from instrumentation import timed
+
+
+SEGMENT_COLUMNS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+DEFAULT_MIN_SUPPORT = 0.001
+
+
+def _indicator(codes, n_rows):
+    # Sparse (n_rows, len(codes)) matrix with a 1 at (codes[j], j); negative codes are left out
+    known = np.flatnonzero(codes >= 0)
+    return sparse.csr_matrix(
+        (np.ones(len(known)), (codes[known], known)), shape=(n_rows, len(codes))
+    )
+
+
+def _support_counts(baskets, itemsets):
+    # Number of baskets containing every item of each itemset (rows of an (m, k) array of columns)
+    counts = baskets[:, itemsets[:, 0]]
+    for position in range(1, itemsets.shape[1]):
+        counts = counts.multiply(baskets[:, itemsets[:, position]])
+    return np.asarray(counts.sum(axis=0)).ravel()
+
+
+def _join_candidates(frequent):
+    """
+    A-priori candidates of size k + 1 from the frequent k-itemsets (sorted rows).
+
+    Two itemsets sharing their first k - 1 items are joined, and a candidate is
+    kept only when all of its k-subsets are frequent.
+    """
+    k = frequent.shape[1]
+    known = {tuple(itemset) for itemset in frequent.tolist()}
+    prefixes = {}
+    for itemset in frequent.tolist():
+        prefixes.setdefault(tuple(itemset[:-1]), []).append(itemset[-1])
+
+    candidates = []
+    for prefix, last_items in prefixes.items():
+        for i, first in enumerate(last_items):
+            for second in last_items[i + 1:]:
+                candidate = prefix + (first, second)
+                if all(candidate[:drop] + candidate[drop + 1:] in known for drop in range(k - 1)):
+                    candidates.append(candidate)
+    return np.array(candidates, dtype=np.intp).reshape(-1, k + 1)
+
+
+class PurchaseMatrix:
+    """
+    Sparse purchases of one product column per customer and per basket.
+
+    items are the distinct values of the product column, cards the sorted
+    loyalty card numbers, quantity the (cards, items) PROD_QTY matrix, baskets
+    the (baskets, items) 0/1 matrix, basket_cards the card position of every
+    basket and segments the segment labels of each card.
+    """
+
+    def __init__(self, item_column, items, cards, quantity, baskets, basket_cards, segments=None):
+        self.item_column = item_column
+        self.items = items
+        self.cards = cards
+        self.quantity = quantity
+        self.baskets = baskets
+        self.basket_cards = basket_cards
+        self.segments = segments or {}
+
+    @classmethod
+    @timed('purchase_matrix')
+    def from_transactions(cls, transactions, item_column='BRAND', segment_columns=SEGMENT_COLUMNS):
+        # Build both matrices (and each card's segment) in one pass over the rows
+        card_codes, cards = pd.factorize(transactions['LYLTY_CARD_NBR'], sort=True)
+        item_codes, items = pd.factorize(transactions[item_column], sort=True)
+        quantity = transactions['PROD_QTY'].to_numpy(dtype=np.float64) if 'PROD_QTY' in transactions else 1.0
+
+        # Unknown items (NaN) are left out of both matrices
+        known = item_codes >= 0
+        purchases = sparse.csr_matrix(
+            (np.broadcast_to(quantity, len(item_codes))[known], (card_codes[known], item_codes[known])),
+            shape=(len(cards), len(items)),
+        )
+
+        # A basket is one TXN_ID of one loyalty card
+        basket_codes, basket_keys = pd.factorize(
+            pd.MultiIndex.from_arrays([card_codes, transactions['TXN_ID'].to_numpy()])
+        )
+        baskets = sparse.csr_matrix(
+            (np.ones(int(known.sum())), (basket_codes[known], item_codes[known])),
+            shape=(len(basket_keys), len(items)),
+        )
+        baskets.data[:] = 1.0
+        basket_cards = basket_keys.get_level_values(0).to_numpy()
+
+        # A card has a single segment, so the label of any of its rows will do
+        segments = {}
+        first_rows = np.full(len(cards), -1, dtype=np.int64)
+        first_rows[card_codes[::-1]] = np.arange(len(card_codes))[::-1]
+        for column in segment_columns:
+            if column in transactions:
+                segments[column] = transactions[column].iloc[first_rows].reset_index(drop=True)
+
+        items = pd.Index(items, name=item_column)
+        return cls(item_column, items, np.asarray(cards), purchases, baskets, basket_cards, segments)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def _segment_codes(self):
+        # Segment code of every card over the combinations of the segment columns (-1 when a label is missing)
+        labels = pd.DataFrame(self.segments)
+        complete = labels.notna().all(axis=1).to_numpy()
+        codes = np.full(len(labels), -1, dtype=np.intp)
+        segment_index = labels[complete].drop_duplicates().sort_values(list(labels)).reset_index(drop=True)
+        lookup = pd.MultiIndex.from_frame(segment_index)
+        codes[complete] = lookup.get_indexer(pd.MultiIndex.from_frame(labels[complete]))
+        return codes, segment_index
+
+    def _card_mask(self, where):
+        # Cards whose segment labels match the {column: value or list of values} filter
+        mask = np.ones(len(self.cards), dtype=bool)
+        for column, values in (where or {}).items():
+            values = [values] if np.isscalar(values) else list(values)
+            mask &= self.segments[column].isin(values).to_numpy()
+        return mask
+
+    @timed('segment_affinity')
+    def segment_affinity(self):
+        """
+        Affinity of every segment to every item against the rest of the population.
+
+        One row per segment and item with
+        - customers: the segment's customers who bought the item,
+        - support / rest_support: that share of the segment's customers and the
+          same share among the customers of every other segment,
+        - lift: support / rest_support,
+        - quantity_share / rest_quantity_share: the item's share of the units
+          the segment (and the rest) bought, and quantity_lift, their ratio.
+        Rows are sorted by segment and then by lift, highest first. Customers
+        without segment labels are left out of both sides.
+        """
+        codes, segment_index = self._segment_codes()
+        indicator = _indicator(codes, len(segment_index))
+
+        bought = self.quantity.copy()
+        bought.data[:] = 1.0
+        customers = np.asarray((indicator @ bought).todense())
+        units = np.asarray((indicator @ self.quantity).todense())
+        segment_customers = np.bincount(codes[codes >= 0], minlength=len(segment_index)).astype(np.float64)
+        segment_units = units.sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            support = customers / segment_customers[:, None]
+            rest_support = (customers.sum(axis=0) - customers) / (segment_customers.sum() - segment_customers)[:, None]
+            quantity_share = units / segment_units[:, None]
+            rest_quantity_share = (units.sum(axis=0) - units) / (segment_units.sum() - segment_units)[:, None]
+            lift = support / rest_support
+            quantity_lift = quantity_share / rest_quantity_share
+
+        n_items = len(self.items)
+        affinity = segment_index.loc[segment_index.index.repeat(n_items)].reset_index(drop=True)
+        affinity[self.item_column] = np.tile(self.items.to_numpy(), len(segment_index))
+        for name, values in [
+            ('customers', customers), ('support', support), ('rest_support', rest_support), ('lift', lift),
+            ('quantity_share', quantity_share), ('rest_quantity_share', rest_quantity_share),
+            ('quantity_lift', quantity_lift),
+        ]:
+            affinity[name] = values.ravel()
+        affinity['customers'] = affinity['customers'].astype(np.int64)
+        segment_position = np.repeat(np.arange(len(segment_index)), n_items)
+        order = np.lexsort((-np.nan_to_num(affinity['lift'].to_numpy(), nan=-np.inf), segment_position))
+        return affinity.iloc[order].reset_index(drop=True)
+
+    @timed('frequent_itemsets')
+    def frequent_itemsets(self, min_support=DEFAULT_MIN_SUPPORT, max_size=3, where=None):
+        """
+        Itemsets contained in at least min_support of the baskets (a-priori).
+
+        where restricts the baskets to customers of a {segment column: value or
+        list of values} filter. Items below min_support are dropped before
+        pairs are counted (one sparse co-occurrence product), and larger
+        candidates are only counted when all their subsets are frequent, over
+        the baskets that still hold enough frequent items. Returns itemset (a
+        tuple of items), size, baskets, support and lift (support over the
+        product of the single-item supports), largest support first within
+        each size.
+        """
+        baskets = self.baskets[np.flatnonzero(self._card_mask(where)[self.basket_cards])]
+        n_baskets = baskets.shape[0]
+        columns = {'itemset': [], 'size': [], 'baskets': [], 'support': [], 'lift': []}
+        if n_baskets == 0:
+            return pd.DataFrame(columns)
+        min_count = max(math.ceil(min_support * n_baskets - 1e-9), 1)
+
+        counts = np.asarray(baskets.sum(axis=0)).ravel()
+        item_support = counts / n_baskets
+        frequent_items = np.flatnonzero(counts >= min_count)
+        baskets = baskets[:, frequent_items]
+
+        # Itemsets of the current size as sorted rows of positions in frequent_items
+        level = np.arange(len(frequent_items))[:, None]
+        level_counts = counts[frequent_items]
+        size = 1
+        while len(level):
+            for positions, count in zip(level, level_counts):
+                itemset = frequent_items[positions]
+                columns['itemset'].append(tuple(self.items[itemset]))
+                columns['size'].append(size)
+                columns['baskets'].append(int(count))
+                columns['support'].append(count / n_baskets)
+                columns['lift'].append(count / n_baskets / np.prod(item_support[itemset]))
+            if size == max_size:
+                break
+
+            # Baskets with fewer than size + 1 frequent items cannot hold a larger itemset
+            baskets = baskets[np.flatnonzero(np.diff(baskets.indptr) > size)]
+            size += 1
+            if size == 2:
+                co_occurrence = sparse.triu(baskets.T @ baskets, k=1).tocoo()
+                keep = co_occurrence.data >= min_count
+                candidates = np.column_stack([co_occurrence.row[keep], co_occurrence.col[keep]]).astype(np.intp)
+                candidate_counts = co_occurrence.data[keep]
+            else:
+                candidates = _join_candidates(level)
+                candidate_counts = _support_counts(baskets, candidates) if len(candidates) else np.array([])
+                keep = candidate_counts >= min_count
+                candidates, candidate_counts = candidates[keep], candidate_counts[keep]
+
+            order = np.lexsort(candidates.T[::-1])
+            level, level_counts = candidates[order], candidate_counts[order]
+
+        itemsets = pd.DataFrame(columns)
+        order = np.lexsort((-itemsets['support'].to_numpy(), itemsets['size'].to_numpy()))
+        return itemsets.iloc[order].reset_index(drop=True)
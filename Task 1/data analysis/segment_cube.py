@@ -0,0 +1,143 @@
+"""
+Segment cube of the merged dataset.
+
+One grouped pass over the transactions collects, per (LIFESTAGE,
+PREMIUM_CUSTOMER, BRAND, pack size, MONTH_YEAR) cell, the number of
+transactions, the sales sum and sum of squares, the PROD_NBR sum and the
+number of distinct loyalty cards. The Part 2 heatmaps, bar charts and t-test
+inputs are then slices of this small table instead of new scans of merged_df.
+"""
+
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import ttest_ind_from_stats
+
+from instrumentation import timed
+from merged_data import _has_parquet_engine, cache_path_for, read_merged_data
+
+
+CUBE_DIMENSIONS = ['LIFESTAGE', 'PREMIUM_CUSTOMER', 'BRAND', 'PACK_SIZE (in grams)', 'MONTH_YEAR']
+SEGMENT_DIMENSIONS = ['LIFESTAGE', 'PREMIUM_CUSTOMER']
+
+# Measures that can be summed over any dimension
+ADDITIVE_MEASURES = ['count', 'sales_sum', 'sales_sumsq', 'prod_nbr_sum']
+
+# Columns of the merged dataset the cube is built from
+CUBE_SOURCE_COLUMNS = CUBE_DIMENSIONS + ['TOT_SALES', 'PROD_NBR', 'LYLTY_CARD_NBR']
+
+
+def cube_path_for(csv_path):
+    # The cube lives next to MergedData.csv
+    return Path(csv_path).with_name('SegmentCube.parquet')
+
+
+@timed('segment_cube')
+def build_segment_cube(merged):
+    """
+    Aggregate the merged transactions into the segment cube in one groupby.
+
+    Sales are accumulated in float64 whatever the input dtype (the compact
+    layout keeps TOT_SALES as float32). Only non-empty cells are kept.
+    """
+    sales = merged['TOT_SALES'].to_numpy(dtype=np.float64)
+    source = merged[CUBE_DIMENSIONS + ['PROD_NBR', 'LYLTY_CARD_NBR']].assign(
+        TOT_SALES=sales, TOT_SALES_SQ=sales * sales, PROD_NBR=merged['PROD_NBR'].astype('int64'),
+    )
+
+    cube = source.groupby(CUBE_DIMENSIONS, observed=True, sort=True).agg(
+        count=('TOT_SALES', 'size'),
+        sales_sum=('TOT_SALES', 'sum'),
+        sales_sumsq=('TOT_SALES_SQ', 'sum'),
+        prod_nbr_sum=('PROD_NBR', 'sum'),
+        customers=('LYLTY_CARD_NBR', 'nunique'),
+    )
+    return cube.reset_index()
+
+
+def load_segment_cube(csv_path, refresh=True):
+    """
+    Load the persisted cube for MergedData.csv, rebuilding it when it is stale.
+
+    The cube is stale when it is missing or older than the CSV or its Parquet
+    cache. A rebuilt cube is written back when refresh is set and pyarrow is
+    installed.
+    """
+    path = cube_path_for(csv_path)
+    sources = [Path(csv_path), cache_path_for(csv_path)]
+    newest_source = max((source.stat().st_mtime for source in sources if source.exists()), default=0)
+
+    if _has_parquet_engine() and path.exists() and path.stat().st_mtime >= newest_source:
+        return pd.read_parquet(path)
+
+    cube = build_segment_cube(read_merged_data(csv_path, columns=CUBE_SOURCE_COLUMNS))
+    if refresh:
+        if _has_parquet_engine():
+            cube.to_parquet(path, index=False)
+        else:
+            warnings.warn('pyarrow is not installed, the segment cube is not persisted')
+    return cube
+
+
+def slice_cube(cube, by, where=None):
+    """
+    Roll the cube up to the dimensions in by.
+
+    where is an optional {dimension: value or list of values} filter applied
+    first. Distinct customers are only kept when the collapsed dimensions are
+    segment dimensions (a customer belongs to a single segment); across brands,
+    pack sizes or months they would be counted more than once.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    if where:
+        for dimension, values in where.items():
+            values = [values] if np.isscalar(values) else list(values)
+            cube = cube[cube[dimension].isin(values)]
+
+    measures = list(ADDITIVE_MEASURES)
+    if set(CUBE_DIMENSIONS) - set(by) <= set(SEGMENT_DIMENSIONS):
+        measures.append('customers')
+
+    if not by:
+        return cube[measures].sum()
+    return cube.groupby(by, observed=True, sort=True)[measures].sum()
+
+
+def segment_pivot(cube, measure):
+    """
+    LIFESTAGE x PREMIUM_CUSTOMER table of a cube measure.
+
+    measure is one of the cube columns or 'avg_sales' (mean TOT_SALES per
+    transaction) or 'avg_prod_nbr' (mean PROD_NBR per transaction).
+    """
+    segments = slice_cube(cube, SEGMENT_DIMENSIONS)
+    if measure == 'avg_sales':
+        values = segments['sales_sum'] / segments['count']
+    elif measure == 'avg_prod_nbr':
+        values = segments['prod_nbr_sum'] / segments['count']
+    else:
+        values = segments[measure]
+    return values.unstack('PREMIUM_CUSTOMER')
+
+
+def sales_stats(cube, where=None):
+    # (mean, sample standard deviation, n) of TOT_SALES over the selected cells
+    totals = slice_cube(cube, [], where)
+    n = totals['count']
+    mean = totals['sales_sum'] / n
+    variance = (totals['sales_sumsq'] - n * mean * mean) / (n - 1)
+    return mean, np.sqrt(max(variance, 0.0)), n
+
+
+def sales_welch_ttest(cube, where_a, where_b):
+    """
+    Welch's t-test on TOT_SALES between two slices of the cube.
+
+    Equivalent to ttest_ind(a, b, equal_var=False) on the transaction rows,
+    computed from the count, sum and sum of squares of each slice.
+    """
+    mean_a, std_a, n_a = sales_stats(cube, where_a)
+    mean_b, std_b, n_b = sales_stats(cube, where_b)
+    return ttest_ind_from_stats(mean_a, std_a, n_a, mean_b, std_b, n_b, equal_var=False)
@@ -0,0 +1,249 @@
+"""
+Content-addressed on-disk cache for pipeline stage results.
+
+A stage result is stored under a key made from the stage name, the code of the
+function that computes it and of every project module it depends on, and a
+fingerprint of its inputs and parameters (DataFrames and input files are hashed
+by content). Re-running an analysis therefore only recomputes the stages whose inputs,
+parameters or code changed. The cache is bounded in size and evicts the least
+recently used results first.
+
+    cache = StageCache('stage_cache')
+    controls = cache.cached('controls', select_controls, matrices, trials)
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Bump to invalidate every cached result (e.g. after a change in the pickled types)
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+# Input files are hashed by content, read in blocks of this size
+FILE_BLOCK_SIZE = 1024 ** 2
+
+
+def update_fingerprint(digest, value):
+    """
+    Feed a content fingerprint of value into a hashlib digest.
+
+    Handles DataFrames/Series (by content, labels and dtypes), NumPy arrays,
+    files given as pathlib.Path (name and content), dicts, lists/tuples and
+    any other picklable value.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else value.name
+        digest.update(repr((labels, value.index.names, str(value.dtypes))).encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, Path):
+        digest.update(repr(value.name).encode())
+        with open(value, 'rb') as file:
+            for block in iter(lambda: file.read(FILE_BLOCK_SIZE), b''):
+                digest.update(block)
+    elif isinstance(value, dict):
+        digest.update(b'{')
+        for key in sorted(value, key=repr):
+            digest.update(repr(key).encode())
+            update_fingerprint(digest, value[key])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[')
+        for item in value:
+            update_fingerprint(digest, item)
+        digest.update(b']')
+    else:
+        digest.update(pickle.dumps(value))
+
+
+def fingerprint(*values):
+    # Hex fingerprint of any number of values
+    digest = hashlib.sha256()
+    for value in values:
+        update_fingerprint(digest, value)
+    return digest.hexdigest()
+
+
+def _code_fingerprint(code):
+    # Bytecode, constants and global names of a code object, nested functions and lambdas included
+    constants = []
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            constants.append(_code_fingerprint(constant))
+        elif isinstance(constant, frozenset):
+            # Set literals compile to frozensets, whose repr order changes between runs
+            constants.append(sorted(map(repr, constant)))
+        else:
+            constants.append(repr(constant))
+    return code.co_code, repr(constants), code.co_names
+
+
+def _is_project_module(module):
+    # Modules of this repository, not of the standard library or installed packages
+    path = getattr(module, '__file__', None)
+    return path is not None and not os.path.abspath(path).startswith((sys.prefix, sys.base_prefix))
+
+
+def _source_digest(obj):
+    # Hash of the source of obj, '' when it is not available (builtins, interactive code)
+    try:
+        return hashlib.sha256(inspect.getsource(obj).encode()).hexdigest()
+    except (OSError, TypeError):
+        return ''
+
+
+def _referenced_module(value):
+    # Module a global refers to: the module itself, or the module defining a function or class
+    if inspect.ismodule(value):
+        return value
+    if inspect.isfunction(value) or inspect.isclass(value) or inspect.isbuiltin(value):
+        return inspect.getmodule(inspect.unwrap(value) if inspect.isfunction(value) else value)
+    return None
+
+
+def _project_dependencies(module_globals, names):
+    # {name: module} of the project modules that the given globals refer to, followed
+    # transitively through the globals of every project module found
+    found = {}
+    pending = [module_globals.get(name) for name in names]
+    while pending:
+        module = _referenced_module(pending.pop())
+        if module is None or module.__name__ in found or not _is_project_module(module):
+            continue
+        found[module.__name__] = module
+        pending.extend(vars(module).values())
+    return found
+
+
+def function_fingerprint(function):
+    """
+    Identity of the code that computes a stage (not of a decorator's wrapper).
+
+    Covers the function's name, bytecode, constants and global names, the
+    source of its module (or of the function itself when the module has no
+    source file, as in a notebook) and the source of every project module it
+    depends on: the ones its module (in a notebook, the function) refers to
+    and, transitively, the ones those refer to. Editing a constant or any
+    helper down the call chain changes the fingerprint.
+    """
+    function = inspect.unwrap(function)
+    module = sys.modules.get(function.__module__)
+    if _is_project_module(module):
+        own_source = _source_digest(module)
+        dependencies = _project_dependencies(vars(module), list(vars(module)))
+        dependencies.pop(module.__name__, None)
+    else:
+        names = set()
+
+        def collect_names(code):
+            names.update(code.co_names)
+            for constant in code.co_consts:
+                if inspect.iscode(constant):
+                    collect_names(constant)
+
+        collect_names(function.__code__)
+        own_source = _source_digest(function)
+        dependencies = _project_dependencies(function.__globals__, names)
+    helper_sources = [(name, _source_digest(dependencies[name])) for name in sorted(dependencies)]
+
+    return (f'{function.__module__}.{function.__qualname__}', _code_fingerprint(function.__code__),
+            own_source, helper_sources)
+
+
+class StageCache:
+    """
+    Size-bounded LRU cache of stage results in cache_dir.
+
+    Every result is a pickle file <cache_dir>/<stage>/<key>.pkl. A hit refreshes
+    the file's modification time, and after each store the least recently used
+    files are deleted until the cache is below max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stage, function, *inputs, **params):
+        return fingerprint(CACHE_VERSION, stage, function_fingerprint(function), inputs, params)
+
+    def _path(self, stage, key):
+        return self.cache_dir / stage / f'{key}.pkl'
+
+    def get(self, stage, key):
+        # (True, result) for a cached key, (False, None) otherwise
+        path = self._path(stage, key)
+        try:
+            with open(path, 'rb') as file:
+                result = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(path)
+        return True, result
+
+    def put(self, stage, key, result):
+        path = self._path(stage, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a truncated entry
+        temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temporary, 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        self.evict()
+
+    def cached(self, stage, function, *inputs, **params):
+        """
+        Return function(*inputs, **params), computing it only on a cache miss.
+
+        The key covers the stage name, the function's code (see
+        function_fingerprint) and the fingerprint of every input and parameter.
+        """
+        key = self.key(stage, function, *inputs, **params)
+        hit, result = self.get(stage, key)
+        if hit:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = function(*inputs, **params)
+        self.put(stage, key, result)
+        return result
+
+    def entries(self):
+        # (modification time, size, path) of every cached result, least recently used first
+        if not self.cache_dir.exists():
+            return []
+        entries = []
+        for path in self.cache_dir.glob('*/*.pkl'):
+            stat = path.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # Delete least recently used results until the cache fits in max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        return total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            path.unlink(missing_ok=True)
@@ -0,0 +1,202 @@
+"""
+Chunked, streaming ingest of the QVI transaction data.
+
+The workbook (or a CSV export of it) is read in bounded-size chunks and every
+chunk is cleaned the same way Part 1 cleans the full table before the next one
+is read: Excel serial dates converted, non-chip products dropped, the
+PROD_QTY == 200 outlier removed and duplicate rows dropped.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+from product_parser import product_attribute
+
+# Quantity of the commercial buyer identified as an outlier in Part 1
+OUTLIER_QTY = 200
+
+DEFAULT_CHUNKSIZE = 100_000
+
+# Fixed dtypes so every chunk hashes and concatenates the same way, whatever
+# values happen to be in it
+TRANSACTION_DTYPES = {
+    'STORE_NBR': 'int64',
+    'LYLTY_CARD_NBR': 'int64',
+    'TXN_ID': 'int64',
+    'PROD_NBR': 'int64',
+    'PROD_NAME': 'object',
+    'PROD_QTY': 'int64',
+    'TOT_SALES': 'float64',
+}
+
+
+def _iter_excel_chunks(path, chunksize):
+    # openpyxl's read-only mode streams the sheet row by row instead of loading it whole
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows))
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+def iter_transaction_chunks(path, chunksize=DEFAULT_CHUNKSIZE):
+    # Yield the raw transaction rows chunksize rows at a time from an .xlsx or .csv file
+    if Path(path).suffix.lower() in ('.xlsx', '.xlsm'):
+        yield from _iter_excel_chunks(path, chunksize)
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+def convert_excel_dates(dates):
+    # Convert Excel serial number dates to datetime (CSV exports may already hold dates)
+    if pd.api.types.is_numeric_dtype(dates):
+        return pd.to_datetime(dates, unit='D', origin='1899-12-30')
+    return pd.to_datetime(dates)
+
+
+def is_chip_product(prod_names):
+    # False for products whose name contains one of the non-chip words (parsed once per distinct name)
+    return product_attribute(prod_names, 'IS_CHIP').astype(bool)
+
+
+def clean_transaction_chunk(chunk):
+    """
+    Apply the Part 1 row-level cleaning to one chunk of transactions.
+
+    Converts DATE, removes non-chip products and the PROD_QTY == 200 outlier.
+    Duplicates are handled across chunks by stream_clean_transactions().
+    """
+    chunk = chunk.astype({column: dtype for column, dtype in TRANSACTION_DTYPES.items() if column in chunk})
+    chunk['DATE'] = convert_excel_dates(chunk['DATE'])
+    chunk = chunk[is_chip_product(chunk['PROD_NAME'])]
+    return chunk[chunk['PROD_QTY'] != OUTLIER_QTY]
+
+
+class RowDeduplicator:
+    """
+    Drop rows already seen in earlier chunks, keeping the first occurrence.
+
+    Rows are looked up by a 64-bit hash and confirmed by comparing their full
+    key (every column encoded as int64: text as a code, floats and dates by
+    their bits), so a hash collision never drops a distinct row. The distinct
+    rows seen so far are kept as sorted runs that are merged like a binary
+    counter, so a chunk costs one search per run instead of a re-sort of
+    everything seen.
+
+    Memory grows linearly with the number of distinct rows (a hash plus one
+    int64 per column for each, about 72 bytes per transaction), since a
+    duplicate can turn up in any later chunk of an unsorted stream. When that
+    does not fit, deduplicate per month partition with out_of_core instead.
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.codes = {}
+
+    def _keys(self, chunk):
+        # (rows, columns) int64 array that two rows share only when all their values are equal
+        columns = []
+        for name in chunk.columns:
+            values = chunk[name]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                columns.append(values.to_numpy(dtype='datetime64[ns]').view(np.int64))
+            elif pd.api.types.is_float_dtype(values):
+                columns.append(values.to_numpy(dtype=np.float64).view(np.int64))
+            elif pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values):
+                columns.append(values.to_numpy(dtype=np.int64))
+            else:
+                # Codes of text values stay the same across chunks; missing values get -1
+                local, uniques = pd.factorize(values)
+                codes = self.codes.setdefault(name, {})
+                mapping = np.array([codes.setdefault(value, len(codes)) for value in uniques] + [-1], dtype=np.int64)
+                columns.append(mapping[local])
+        return np.column_stack(columns) if columns else np.empty((len(chunk), 0), dtype=np.int64)
+
+    def _seen(self, hashes, keys, rows):
+        # Which of the given rows match a row of an earlier chunk (same hash and same key)
+        seen = np.zeros(len(rows), dtype=bool)
+        for run_hashes, run_keys in self.runs:
+            first = np.searchsorted(run_hashes, hashes[rows], side='left')
+            matches = np.searchsorted(run_hashes, hashes[rows], side='right') - first
+            # Almost always one match per hash; colliding hashes are checked one offset at a time
+            for offset in range(matches.max(initial=0)):
+                candidates = np.flatnonzero(~seen & (matches > offset))
+                equal = (run_keys[first[candidates] + offset] == keys[rows[candidates]]).all(axis=1)
+                seen[candidates[equal]] = True
+        return seen
+
+    def _add_run(self, hashes, keys):
+        # Add the new distinct rows as a sorted run, merging runs no larger than it
+        order = np.argsort(hashes, kind='stable')
+        self.runs.append((hashes[order], keys[order]))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= len(self.runs[-1][0]):
+            (older_hashes, older_keys), (newer_hashes, newer_keys) = self.runs[-2:]
+            hashes = np.concatenate([older_hashes, newer_hashes])
+            keys = np.concatenate([older_keys, newer_keys])
+            order = np.argsort(hashes, kind='stable')
+            self.runs[-2:] = [(hashes[order], keys[order])]
+
+    def __call__(self, chunk):
+        hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        keys = self._keys(chunk)
+
+        # Exact duplicates inside the chunk, then against everything seen before
+        keep = ~chunk.duplicated().to_numpy()
+        rows = np.flatnonzero(keep)
+        keep[rows[self._seen(hashes, keys, rows)]] = False
+
+        if keep.any():
+            self._add_run(hashes[keep], keys[keep])
+        return chunk[keep]
+
+
+def stream_clean_transactions(path, chunksize=DEFAULT_CHUNKSIZE, raw_output_path=None):
+    """
+    Yield cleaned transaction chunks from the workbook or its CSV export.
+
+    Each chunk is fully cleaned (dates, non-chip filter, outlier, duplicates)
+    before the next one is read. Memory is one chunk plus the hashes and keys
+    of the distinct rows seen so far, which grow with the extract (see
+    RowDeduplicator). With
+    raw_output_path every raw chunk is also appended, as read, to that CSV, a
+    plain export of the workbook from the same pass.
+    """
+    deduplicate = RowDeduplicator()
+    for number, chunk in enumerate(iter_transaction_chunks(path, chunksize)):
+        if raw_output_path is not None:
+            chunk.to_csv(raw_output_path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+        chunk = deduplicate(clean_transaction_chunk(chunk))
+        if not chunk.empty:
+            yield chunk
+
+
+@timed('ingest')
+def load_clean_transactions(path, chunksize=DEFAULT_CHUNKSIZE):
+    # Collect the cleaned chunks into one frame (only the cleaned rows are ever held)
+    chunks = list(stream_clean_transactions(path, chunksize))
+    return pd.concat(chunks, ignore_index=True)
+
+
+@timed('ingest')
+def write_clean_transactions(path, output_path, chunksize=DEFAULT_CHUNKSIZE, raw_output_path=None):
+    # Stream cleaned chunks straight to a CSV file without holding the result in memory
+    # (and the raw chunks to raw_output_path, if given)
+    rows = 0
+    for number, chunk in enumerate(stream_clean_transactions(path, chunksize, raw_output_path)):
+        chunk.to_csv(output_path, mode='w' if number == 0 else 'a', header=number == 0, index=False)
+        rows += len(chunk)
+    return rows
@@ -0,0 +1,411 @@
+"""
+Local analysis service answering from warm in-memory data.
+
+AnalysisState loads the merged dataset once and keeps the monthly metrics, the
+store x month matrices and the segment cube in memory, so a question costs one
+scoring pass or one cube slice instead of a re-run of Task2_Data_Analytics.py.
+serve() exposes it over HTTP (standard library only) with JSON responses:
+
+    GET  /status                                                   months, stores and rows loaded
+    GET  /controls?store=77&pre_window=2018-07,2019-01&k=5          best controls of trial stores
+    GET  /uplift?store=77,86&pre_window=...&trial_window=...        uplift against the best controls
+    GET  /cube?by=LIFESTAGE,PREMIUM_CUSTOMER&BRAND=Kettle,Smiths    segment cube slice
+    POST /refresh                                                   fold newly landed monthly files
+
+    python analysis_service.py --merged MergedData.csv --incoming incoming --port 8765
+
+Monthly files (CSV or Parquet with the MergedData.csv columns) dropped into the
+incoming directory are folded in by refresh(), on request or every --poll
+seconds. A monthly file holds the full rows of the months it covers: they
+replace those months' rows (from MergedData.csv or an earlier file), so a
+corrected file re-landed under the same name, recognised by its content
+fingerprint, replaces the rows it sent before instead of adding to them. Only
+the MonthlyMetricsStore partitions and the cube cells of their months are
+recomputed; the matrices are re-pivoted from the updated metrics. A file that
+cannot be read in the merged schema is moved to incoming/rejected and
+reported, and the other files are still folded in.
+"""
+
+import argparse
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+# The MergedData loader, the segment cube and the stage instrumentation are shared with Task 1
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'Task 1' / 'data analysis'))
+
+from control_scoring import PRE_TRIAL_WINDOW, SCORE_METRICS, build_store_month_matrices  # noqa: E402
+from instrumentation import timed  # noqa: E402
+from merged_data import apply_merged_schema, read_merged_data  # noqa: E402
+from monthly_metrics_store import METRIC_COLUMNS, MonthlyMetricsStore  # noqa: E402
+from segment_cube import CUBE_DIMENSIONS, CUBE_SOURCE_COLUMNS, build_segment_cube, load_segment_cube, slice_cube  # noqa: E402
+from stage_cache import fingerprint  # noqa: E402
+from trial_evaluation import (  # noqa: E402
+    TRIAL_WINDOW, compute_uplift, normalize_trials, select_controls, summarize_uplift, top_k_controls,
+)
+
+
+# Columns of the merged dataset kept in memory: the monthly metrics and segment cube inputs
+SERVICE_COLUMNS = list(dict.fromkeys(['STORE_NBR', 'TXN_ID'] + CUBE_SOURCE_COLUMNS))
+
+# Monthly metrics columns the store x month matrices are built for
+MATRIX_METRICS = METRIC_COLUMNS[2:]
+
+DEFAULT_PORT = 8765
+
+# Subdirectory of the incoming directory that unreadable monthly files are moved to
+REJECTED_DIR = 'rejected'
+
+# What reading a malformed monthly file raises (missing columns, parse or cast errors)
+FILE_ERRORS = (KeyError, ValueError, TypeError, OSError)
+
+
+def read_monthly_file(path):
+    # One landed monthly file in the merged schema, limited to the service columns
+    path = Path(path)
+    frame = pd.read_parquet(path) if path.suffix == '.parquet' else pd.read_csv(path)
+    return apply_merged_schema(frame[SERVICE_COLUMNS])
+
+
+def replace_months(merged, frames):
+    """
+    Rows of merged with every month covered by one of the frames replaced.
+
+    Frames are applied in order, each replacing the whole of the months it
+    covers, so for a month covered by several frames only the last one's rows
+    are kept. Returns the new rows and the sorted list of replaced months.
+    """
+    owner = {}
+    for number, frame in enumerate(frames):
+        owner.update(dict.fromkeys(frame['MONTH_YEAR'].astype(str).unique(), number))
+    kept = [merged[~merged['MONTH_YEAR'].astype(str).isin(owner)]]
+    for number, frame in enumerate(frames):
+        months = frame['MONTH_YEAR'].astype(str)
+        kept.append(frame[months.map(owner).to_numpy() == number])
+    return apply_merged_schema(pd.concat(kept, ignore_index=True)), sorted(owner)
+
+
+def complete_stores(monthly_metrics):
+    # Stores with metrics in every month of the history (the script's 12-month filter)
+    months_per_store = monthly_metrics.groupby('STORE_NBR')['MONTH_YEAR'].nunique()
+    return months_per_store.index[months_per_store == monthly_metrics['MONTH_YEAR'].nunique()]
+
+
+def _records(frame):
+    # JSON-ready rows of a DataFrame (NaN becomes null)
+    return json.loads(frame.to_json(orient='records'))
+
+
+class AnalysisState:
+    """
+    Warm data of the service and the queries answered from it.
+
+    merged holds the SERVICE_COLUMNS of every transaction loaded so far,
+    seen_files the content fingerprint of every monthly file folded in,
+    monthly_metrics the metrics of the complete stores, matrices their store
+    x month matrices and cube the segment cube. Queries and refresh() share a
+    lock, so a refresh never runs half-way through a query.
+    """
+
+    def __init__(self, merged_path, state_dir='monthly_metrics_state', incoming_dir=None):
+        self.merged_path = Path(merged_path)
+        self.metrics_store = MonthlyMetricsStore(state_dir)
+        self.incoming_dir = Path(incoming_dir) if incoming_dir is not None else None
+        self.seen_files = {}
+        self.rejected_files = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def _new_files(self):
+        # (path, content fingerprint) of the monthly files that are new or changed since they were folded in
+        if self.incoming_dir is None or not self.incoming_dir.exists():
+            return []
+        files = sorted(path for pattern in ('*.csv', '*.parquet') for path in self.incoming_dir.glob(pattern))
+        fingerprints = [(path, fingerprint(path)) for path in files]
+        return [(path, digest) for path, digest in fingerprints if self.seen_files.get(path.name) != digest]
+
+    def _read_new_files(self):
+        """
+        Read the new monthly files, moving the ones that fail to incoming/rejected.
+
+        Returns the frames of the files that were read, their names and the
+        {name: error} of the files rejected by this call (also kept in
+        rejected_files until a readable file lands under the same name).
+        """
+        frames, names, rejected = [], [], {}
+        for path, digest in self._new_files():
+            try:
+                frames.append(read_monthly_file(path))
+            except FILE_ERRORS as error:
+                rejected[path.name] = f'{type(error).__name__}: {error}'
+                rejected_dir = self.incoming_dir / REJECTED_DIR
+                rejected_dir.mkdir(exist_ok=True)
+                path.replace(rejected_dir / path.name)
+                continue
+            names.append(path.name)
+            self.seen_files[path.name] = digest
+            self.rejected_files.pop(path.name, None)
+        self.rejected_files.update(rejected)
+        return frames, names, rejected
+
+    def _sync_months(self, months):
+        # Re-aggregate the metrics store partitions of the months from the merged rows in memory
+        self.metrics_store.sync(self.merged[self.merged['MONTH_YEAR'].astype(str).isin(months)])
+
+    def _rebuild_views(self):
+        # Metrics of the complete stores and their matrices, from the metrics store partitions
+        all_metrics = self.metrics_store.monthly_metrics()
+        stores = complete_stores(all_metrics)
+        self.monthly_metrics = all_metrics[all_metrics['STORE_NBR'].isin(stores)].reset_index(drop=True)
+        self.matrices = build_store_month_matrices(self.monthly_metrics, MATRIX_METRICS)
+
+    def _rebuild_cube_months(self, months):
+        # Recompute the cube cells of the given months from the merged rows in memory
+        rows = self.merged[self.merged['MONTH_YEAR'].astype(str).isin(months)]
+        kept = self.cube[~self.cube['MONTH_YEAR'].astype(str).isin(months)]
+        cube = pd.concat([kept, build_segment_cube(rows)], ignore_index=True)
+        self.cube = cube.sort_values(CUBE_DIMENSIONS).reset_index(drop=True)
+
+    @timed('service_load')
+    def load(self):
+        """
+        Load MergedData.csv and the monthly files already in the incoming directory.
+
+        The metrics store is synced with all of those rows, so every month
+        whose rows differ from the last run (a file that landed while the
+        service was down included) is re-aggregated, months no longer in the
+        data are dropped, and the rest is reused.
+        """
+        with self._lock:
+            frames, _, _ = self._read_new_files()
+            self.merged, months = replace_months(read_merged_data(self.merged_path, columns=SERVICE_COLUMNS), frames)
+
+            self.metrics_store.sync(self.merged, drop_missing=True)
+            self._rebuild_views()
+            self.cube = load_segment_cube(self.merged_path)
+            if months:
+                self._rebuild_cube_months(months)
+
+    @timed('service_refresh')
+    def refresh(self):
+        """
+        Fold the monthly files that landed or changed since the last load or refresh.
+
+        Each file's rows replace those of the months it covers, and the metrics
+        store partitions and the cube cells of those months are re-aggregated
+        from the merged rows in memory. Returns the files folded in, the
+        months that were updated and the files rejected by this refresh (with
+        their errors).
+        """
+        with self._lock:
+            frames, names, rejected = self._read_new_files()
+            if not frames:
+                return {'files': [], 'months': [], 'rejected': rejected}
+            self.merged, months = replace_months(self.merged, frames)
+
+            self._sync_months(months)
+            self._rebuild_views()
+            self._rebuild_cube_months(months)
+            return {'files': names, 'months': months, 'rejected': rejected}
+
+    def status(self):
+        with self._lock:
+            return {
+                'rows': len(self.merged),
+                'months': [str(month) for month in self.matrices[MATRIX_METRICS[0]].columns],
+                'stores': len(self.monthly_metrics['STORE_NBR'].unique()),
+                'cube_cells': len(self.cube),
+                'files': sorted(self.seen_files),
+                'rejected': self.rejected_files,
+            }
+
+    def _trial_matrices(self, metrics):
+        # The warm matrices of the requested metrics (default: the SCORE_METRICS columns)
+        return {metric: self.matrices[metric] for metric in (metrics or SCORE_METRICS.values())}
+
+    def _check_stores(self, stores):
+        # Trial stores must be complete stores of the matrices
+        known = self.matrices[MATRIX_METRICS[0]].index
+        unknown = [store for store in stores if store not in known]
+        if not stores:
+            raise ValueError('No store given')
+        if unknown:
+            raise ValueError(f'Unknown store(s) {unknown}, expected stores with metrics in every month')
+
+    def controls(self, stores, pre_window=PRE_TRIAL_WINDOW, k=5, metrics=None):
+        # The k best control stores of each trial store over the pre-trial window
+        trials = [{'store': store, 'pre_window': pre_window} for store in stores]
+        with self._lock:
+            self._check_stores(stores)
+            return top_k_controls(self._trial_matrices(metrics), normalize_trials(trials), k=k)
+
+    def uplift(self, stores, pre_window=PRE_TRIAL_WINDOW, trial_window=TRIAL_WINDOW, metrics=None):
+        # (monthly results, summary) of each trial store against its best control
+        trials = normalize_trials(
+            [{'store': store, 'pre_window': pre_window, 'trial_window': trial_window} for store in stores]
+        )
+        with self._lock:
+            self._check_stores(stores)
+            matrices = self._trial_matrices(metrics)
+            results = compute_uplift(matrices, trials, select_controls(matrices, trials))
+        return results, summarize_uplift(results)
+
+    def cube_slice(self, by, where=None):
+        # Segment cube rolled up to the dimensions in by, with the mean sales per transaction
+        with self._lock:
+            sliced = slice_cube(self.cube, by, where)
+        if not by:
+            sliced = sliced.to_frame().T
+        sliced = sliced.reset_index() if by else sliced
+        return sliced.assign(avg_sales=sliced['sales_sum'] / sliced['count'])
+
+
+def _window(params, name, default):
+    # 'start,end' query value -> (start, end), with a clear error for anything else
+    value = params.get(name)
+    if value is None:
+        return default
+    bounds = [bound.strip() for bound in value.split(',')]
+    if len(bounds) != 2 or not all(bounds):
+        raise ValueError(f'{name} must be two periods separated by a comma, e.g. 2018-07,2019-01; got {value!r}')
+    if bounds[0] > bounds[1]:
+        raise ValueError(f'{name} starts after it ends: {value!r}')
+    return bounds[0], bounds[1]
+
+
+def _list(value):
+    # 'a,b,c' query value -> ['a', 'b', 'c']
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+
+def _cube_filter(cube, params):
+    # Query parameters named after a cube dimension filter it; values are cast to the dimension's type
+    where = {}
+    for dimension in CUBE_DIMENSIONS:
+        if dimension in params:
+            values = _list(params[dimension])
+            if pd.api.types.is_numeric_dtype(cube[dimension]):
+                values = [cube[dimension].dtype.type(value) for value in values]
+            where[dimension] = values
+    return where
+
+
+def make_handler(state):
+    """
+    Request handler class bound to an AnalysisState.
+
+    Every response is JSON; bad parameters give a 400, a refresh that rejected
+    files a 422 and unexpected errors a 500, each with an error message.
+    """
+    class AnalysisHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self):
+            # Query parameters, the last value of each
+            return {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+        def do_GET(self):
+            route = urlparse(self.path).path.rstrip('/')
+            params = self._params()
+            try:
+                if route == '/status':
+                    self._send(200, state.status())
+                elif route == '/controls':
+                    controls = state.controls(
+                        [int(store) for store in _list(params['store'])],
+                        _window(params, 'pre_window', PRE_TRIAL_WINDOW),
+                        k=int(params.get('k', 5)), metrics=_list(params.get('metrics')),
+                    )
+                    self._send(200, {'controls': _records(controls)})
+                elif route == '/uplift':
+                    results, summary = state.uplift(
+                        [int(store) for store in _list(params['store'])],
+                        _window(params, 'pre_window', PRE_TRIAL_WINDOW),
+                        _window(params, 'trial_window', TRIAL_WINDOW),
+                        metrics=_list(params.get('metrics')),
+                    )
+                    self._send(200, {'summary': _records(summary), 'results': _records(results)})
+                elif route == '/cube':
+                    sliced = state.cube_slice(_list(params.get('by')), _cube_filter(state.cube, params))
+                    self._send(200, {'rows': _records(sliced)})
+                else:
+                    self._send(404, {'error': f'Unknown endpoint {route!r}'})
+            except (KeyError, ValueError) as error:
+                self._send(400, {'error': f'{type(error).__name__}: {error}'})
+            except Exception as error:
+                self._send(500, {'error': f'{type(error).__name__}: {error}'})
+
+        def do_POST(self):
+            if urlparse(self.path).path.rstrip('/') != '/refresh':
+                self._send(404, {'error': f'Unknown endpoint {self.path!r}'})
+                return
+            try:
+                result = state.refresh()
+                # Rejected files give a 422; the files that were read are still folded in
+                self._send(422 if result['rejected'] else 200, result)
+            except Exception as error:
+                self._send(500, {'error': f'{type(error).__name__}: {error}'})
+
+        def log_message(self, format, *args):
+            # Keep the console quiet; the instrumentation report has the timings
+            pass
+
+    return AnalysisHandler
+
+
+def serve(state, host='127.0.0.1', port=DEFAULT_PORT, poll=None):
+    """
+    Serve an AnalysisState over HTTP until interrupted.
+
+    With poll (seconds) a background thread calls refresh() on that interval,
+    so monthly files dropped into the incoming directory are picked up
+    without a POST /refresh; a failing refresh is reported and retried.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    stop = threading.Event()
+    if poll:
+        def poll_incoming():
+            while not stop.wait(poll):
+                # A failed refresh must not end the polling; report it and try again next interval
+                try:
+                    state.refresh()
+                except Exception as error:
+                    print(f'refresh failed: {type(error).__name__}: {error}', file=sys.stderr)
+        threading.Thread(target=poll_incoming, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve control selection, uplift and segment cube queries.')
+    parser.add_argument('--merged', type=Path, default=Path('MergedData.csv'))
+    parser.add_argument('--state-dir', type=Path, default=Path('monthly_metrics_state'))
+    parser.add_argument('--incoming', type=Path, help='directory new monthly files land in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--poll', type=float, help='check the incoming directory every POLL seconds')
+    args = parser.parse_args()
+
+    state = AnalysisState(args.merged, args.state_dir, args.incoming)
+    print(f'Serving {state.status()["rows"]} rows on http://{args.host}:{args.port}')
+    serve(state, args.host, args.port, args.poll)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Sliding-window backtest of control store selection.
+
+backtest_controls() slides a pre-trial window followed by a trial window across
+the whole store x month history. For every window position it ranks the control
+stores of each trial store, as select_controls() would with that pre-trial
+window, and measures the placebo uplift of the trial store against each ranked
+control over the window's trial months. control_stability() summarises how
+often the best control changes and how large the placebo uplifts get.
+
+Nothing is recomputed per window. Prefix sums over the month axis are built
+once, per store (values and month counts, for the scaling factors and trial
+totals) and per trial/candidate pair (pairwise month counts, sums, sums of
+squares, cross products and absolute differences, for the scores), and every
+window is a difference of two prefix sums. A window costs the same whatever its
+length, so hundreds of windows cost little more than one.
+"""
+
+import numpy as np
+import pandas as pd
+
+from control_scoring import correlation_score, magnitude_score, score_metrics
+from instrumentation import timed
+from trial_evaluation import _top_k_last_axis, candidate_stores, normalize_trials
+
+
+# Relative size below which a window's variance is treated as 0 (a constant series has no correlation)
+VARIANCE_EPS = 1e-12
+
+
+def _prefix(values):
+    # Prefix sums along the last axis with a leading 0: the sum over [start, end) is p[..., end] - p[..., start]
+    zeros = np.zeros(values.shape[:-1] + (1,))
+    return np.concatenate([zeros, np.cumsum(values, axis=-1)], axis=-1)
+
+
+def sliding_windows(n_periods, pre_periods, trial_periods, step=1):
+    # (pre_start, trial_start, trial_end) positions of every window that fits, trial_end exclusive
+    pre_start = np.arange(0, n_periods - pre_periods - trial_periods + 1, step)
+    return pre_start, pre_start + pre_periods, pre_start + pre_periods + trial_periods
+
+
+def pair_prefix_sums(trial_values, candidate_values):
+    """
+    Prefix sums of the pairwise moments of every (trial, candidate) pair.
+
+    Only the months both stores have count, as in score_control_pairs. Each
+    store is centred on its own mean first, which leaves the correlation
+    unchanged but keeps the sums of squares from cancelling.
+    Returns a dict of (trial, candidate, months + 1) arrays.
+    """
+    x = np.asarray(trial_values, dtype=float)[:, None, :]
+    y = np.asarray(candidate_values, dtype=float)[None, :, :]
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x_centred = np.where(valid, x - np.nanmean(trial_values, axis=1)[:, None, None], 0.0)
+    y_centred = np.where(valid, y - np.nanmean(candidate_values, axis=1)[None, :, None], 0.0)
+    return {
+        'n': _prefix(valid.astype(float)),
+        'x': _prefix(x_centred),
+        'y': _prefix(y_centred),
+        'xx': _prefix(x_centred * x_centred),
+        'yy': _prefix(y_centred * y_centred),
+        'xy': _prefix(x_centred * y_centred),
+        'abs': _prefix(np.where(valid, np.abs(x - y), 0.0)),
+    }
+
+
+def window_composite_scores(prefix, start, end):
+    """
+    Composite scores of every pair over months [start, end) for arrays of windows.
+
+    Returns a (window, trial, candidate) array: the average of the correlation
+    and magnitude scores, NaN for pairs without an overlapping month.
+    """
+    def window_sum(name):
+        # (window, trial, candidate) sums from the prefix sums
+        return np.moveaxis(prefix[name][..., end] - prefix[name][..., start], -1, 0)
+
+    n, sx, sy = window_sum('n'), window_sum('x'), window_sum('y')
+    sxx, syy, sxy = window_sum('xx'), window_sum('yy'), window_sum('xy')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        var_x = np.where(var_x > VARIANCE_EPS * sxx, var_x, np.nan)
+        var_y = np.where(var_y > VARIANCE_EPS * syy, var_y, np.nan)
+        corr = np.clip((sxy - sx * sy / n) / np.sqrt(var_x * var_y), -1, 1)
+        corr = np.where(n >= 2, corr, np.nan)
+        diff = np.where(n > 0, window_sum('abs') / n, np.nan)
+    return (correlation_score(corr) + magnitude_score(diff)) / 2
+
+
+@timed('backtest')
+def backtest_controls(matrices, trials, pre_periods=7, trial_periods=3, step=1, k=1):
+    """
+    Control rankings and placebo uplifts for every position of a sliding window.
+
+    matrices is the output of build_store_month_matrices (every metric in it
+    is backtested); the window is pre_periods pre-trial months followed by
+    trial_periods trial months and moves by step months. Trial stores are never
+    used as controls. Returns one row per window, trial store, metric and rank
+    with the window's first and last period label (MONTH_YEAR at month grain), the
+    CONTROL_STORE, control_score, scaling_factor and placebo_uplift (total
+    percentage difference over the window's trial months, as in
+    summarize_uplift). placebo is True when neither period of the window
+    overlaps the trial store's real trial window.
+    """
+    trials = normalize_trials(trials)
+    trial_stores = [trial['store'] for trial in trials]
+    candidates = candidate_stores(matrices, trials)
+    months = next(iter(matrices.values())).columns.to_numpy()
+    pre_start, trial_start, trial_end = sliding_windows(len(months), pre_periods, trial_periods, step)
+
+    # Windows that touch a trial store's real trial months are not placebo tests
+    touches_trial = np.array([
+        (months[pre_start] <= trial['trial_window'][1]) & (months[trial_end - 1] >= trial['trial_window'][0])
+        for trial in trials
+    ]).T.reshape(len(pre_start), len(trials))
+
+    frames = []
+    for metric in score_metrics(list(matrices)).values():
+        matrix = matrices[metric]
+        trial_values = matrix.reindex(trial_stores).to_numpy(dtype=float)
+        candidate_values = matrix.reindex(candidates).to_numpy(dtype=float)
+
+        composite = window_composite_scores(pair_prefix_sums(trial_values, candidate_values), pre_start, trial_start)
+        rows, ranks, positions = _top_k_last_axis(composite, k)
+        window, trial = np.unravel_index(rows, composite.shape[:-1])
+
+        # Scaling factor from each store's own pre-trial mean, placebo uplift from the trial-period totals
+        store_sums = {name: _prefix(np.nan_to_num(values)) for name, values in
+                      [('trial', trial_values), ('control', candidate_values)]}
+        store_counts = {name: _prefix((~np.isnan(values)).astype(float)) for name, values in
+                        [('trial', trial_values), ('control', candidate_values)]}
+
+        def period_total(name, store, start, end):
+            return store_sums[name][store, end] - store_sums[name][store, start]
+
+        def period_mean(name, store, start, end):
+            return period_total(name, store, start, end) / (
+                store_counts[name][store, end] - store_counts[name][store, start]
+            )
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaling_factor = (period_mean('trial', trial, pre_start[window], trial_start[window])
+                              / period_mean('control', positions, pre_start[window], trial_start[window]))
+            total_trial = period_total('trial', trial, trial_start[window], trial_end[window])
+            total_scaled_control = scaling_factor * period_total(
+                'control', positions, trial_start[window], trial_end[window]
+            )
+            placebo_uplift = (total_trial - total_scaled_control) / total_scaled_control * 100
+
+        frames.append(pd.DataFrame({
+            'pre_start': months[pre_start[window]],
+            'pre_end': months[trial_start[window] - 1],
+            'trial_start': months[trial_start[window]],
+            'trial_end': months[trial_end[window] - 1],
+            'TRIAL_STORE': np.asarray(trial_stores)[trial],
+            'metric': metric,
+            'rank': ranks + 1,
+            'CONTROL_STORE': candidates[positions],
+            'control_score': composite.reshape(-1, composite.shape[-1])[rows, positions],
+            'scaling_factor': scaling_factor,
+            'placebo_uplift': placebo_uplift,
+            'placebo': ~touches_trial[window, trial],
+        }))
+
+    backtest = pd.concat(frames, ignore_index=True)
+    order = {store: position for position, store in enumerate(trial_stores)}
+    return backtest.sort_values(
+        ['pre_start', 'TRIAL_STORE'], kind='stable',
+        key=lambda column: column.map(order) if column.name == 'TRIAL_STORE' else column,
+    ).reset_index(drop=True)
+
+
+def control_stability(backtest):
+    """
+    How stable the best control is across the backtest windows.
+
+    One row per trial store and metric: the number of windows, the control
+    that is best most often and the share of windows it is best in, the number
+    of distinct best controls, and the mean and standard deviation of the
+    placebo uplift over the placebo windows (the spread a real trial uplift
+    should stand out from).
+    """
+    best = backtest[backtest['rank'] == 1]
+    grouped = best.groupby(['TRIAL_STORE', 'metric'], sort=False)
+    stability = grouped.agg(
+        windows=('CONTROL_STORE', 'size'),
+        top_control=('CONTROL_STORE', lambda controls: controls.mode().iloc[0]),
+        distinct_controls=('CONTROL_STORE', 'nunique'),
+    )
+    stability['top_control_share'] = grouped['CONTROL_STORE'].agg(
+        lambda controls: (controls == controls.mode().iloc[0]).mean()
+    )
+    placebo = best[best['placebo']].groupby(['TRIAL_STORE', 'metric'], sort=False)['placebo_uplift']
+    stability['placebo_uplift_mean'] = placebo.mean()
+    stability['placebo_uplift_std'] = placebo.std()
+    return stability.reset_index()
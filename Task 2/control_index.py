@@ -0,0 +1,176 @@
+"""
+Pruning index for top-k control store search.
+
+The composite score of a trial/candidate pair is the average of the correlation
+score (r + 1) / 2 and the magnitude score 1 / (1 + d), where d is the mean
+absolute monthly difference. Both have cheap upper bounds that only need a few
+numbers per store, computed once when the index is built:
+
+- r = 1 - |u_t - u_c|^2 / 2 for the centred, unit-norm pre-period trajectories
+  u. Projecting u onto the leading principal directions of all candidates and
+  keeping the norm of the remainder gives a lower bound on |u_t - u_c|, hence
+  an upper bound on r.
+- d >= |mean_t - mean_c| (the mean of absolute differences is at least the
+  absolute difference of the means), which bounds the magnitude score.
+
+A query scores the candidates with the highest bounds exactly, then only the
+remaining candidates whose bound reaches the k-th best exact score, so it returns
+the same top-k (ties broken by candidate order, like nlargest) as scoring every
+store with score_control_pairs. Stores with missing or constant pre-period
+months are never pruned.
+"""
+
+import numpy as np
+import pandas as pd
+
+from control_scoring import (
+    PRE_TRIAL_WINDOW, correlation_score, magnitude_score, pairwise_correlation, pairwise_mean_abs_difference,
+    score_metrics, window_columns,
+)
+
+
+# Principal directions kept per store; the rest of the trajectory is summarised by its norm
+N_COMPONENTS = 3
+
+# Candidates with the highest bounds scored exactly first in a query
+BATCH_SIZE = 32
+
+# Added to every bound so floating point rounding can never prune a true top-k store
+BOUND_SLACK = 1e-9
+
+
+def _unit_trajectories(values):
+    # Means, centred unit-norm rows and the mask of rows they are valid for
+    # (complete and not constant; other rows are always scored exactly)
+    n_months = values.shape[1]
+    complete = ~np.isnan(values).any(axis=1)
+    means = values.mean(axis=1)
+    centred = values - means[:, None]
+    norms = np.sqrt((centred * centred).sum(axis=1))
+    indexable = complete & (norms > 0) & (n_months >= 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unit = np.where(indexable[:, None], centred / norms[:, None], 0.0)
+    return means, unit, indexable
+
+
+def _project(unit, basis):
+    # Coordinates on the basis plus the norm of what the basis does not capture
+    projections = unit @ basis
+    residuals = np.sqrt(np.clip(1 - (projections * projections).sum(axis=1), 0, None))
+    return projections, residuals
+
+
+class ControlCandidateIndex:
+    """
+    Index of candidate store trajectories over one pre-trial window.
+
+    matrices is the output of build_store_month_matrices, and every metric in
+    it is indexed; candidate_stores defaults to every store in them (callers
+    exclude the trial stores).
+    pairs_scored counts the exact pair scores computed by queries so far.
+    """
+
+    def __init__(self, matrices, window=PRE_TRIAL_WINDOW, candidate_stores=None, n_components=N_COMPONENTS):
+        self.window = window
+        self.metrics = score_metrics(list(matrices))
+        self.matrices = {score: window_columns(matrices[metric], window) for score, metric in self.metrics.items()}
+        if candidate_stores is None:
+            candidate_stores = next(iter(self.matrices.values())).index
+        self.candidates = pd.Index(candidate_stores, name='STORE_NBR')
+        self.pairs_scored = 0
+
+        self._entries = {}
+        for score, matrix in self.matrices.items():
+            values = matrix.reindex(self.candidates).to_numpy(dtype=float)
+            means, unit, indexable = _unit_trajectories(values)
+
+            # Leading right singular vectors of the indexable trajectories
+            n_basis = min(n_components, int(indexable.sum()), values.shape[1])
+            if n_basis > 0:
+                basis = np.linalg.svd(unit[indexable], full_matrices=False)[2][:n_basis].T
+            else:
+                basis = np.zeros((values.shape[1], 0))
+            projections, residuals = _project(unit, basis)
+
+            self._entries[score] = {
+                'values': values, 'means': means, 'indexable': indexable, 'basis': basis,
+                'projections': projections, 'residuals': residuals,
+            }
+
+    def upper_bounds(self, score, trial_values):
+        # Upper bounds of the composite score, one row per trial trajectory and one column per candidate
+        entry = self._entries[score]
+        means, unit, indexable = _unit_trajectories(trial_values)
+        projections, residuals = _project(unit, entry['basis'])
+
+        distance_sq = (
+            ((projections[:, None, :] - entry['projections'][None, :, :]) ** 2).sum(axis=-1)
+            + (residuals[:, None] - entry['residuals'][None, :]) ** 2
+        )
+        corr_bound = np.clip(1 - distance_sq / 2, -1, 1)
+        diff_bound = np.abs(means[:, None] - entry['means'][None, :])
+
+        bounds = (correlation_score(corr_bound) + magnitude_score(diff_bound)) / 2 + BOUND_SLACK
+        bounds[~indexable, :] = np.inf
+        bounds[:, ~entry['indexable']] = np.inf
+        return bounds
+
+    def exact_scores(self, score, trial_values, positions):
+        # Composite scores of the candidates at positions, computed as score_control_pairs does
+        candidate_values = self._entries[score]['values'][positions]
+        corr = correlation_score(pairwise_correlation(trial_values[None, :], candidate_values))[0]
+        mag = magnitude_score(pairwise_mean_abs_difference(trial_values[None, :], candidate_values))[0]
+        self.pairs_scored += len(positions)
+        return (corr + mag) / 2
+
+    def top_k_positions(self, score, trial_values, bounds, k):
+        """
+        Candidate positions and composite scores of the k best controls for one trial.
+
+        The BATCH_SIZE (at least 4k) candidates with the highest bounds are
+        scored first; their k-th best score then prunes every candidate whose
+        bound is below it, and the rest are scored in a second pass. Pairs
+        without a score (no overlapping months) are never returned.
+        """
+        n_first = min(max(BATCH_SIZE, 4 * k), len(bounds))
+        first = np.argpartition(-bounds, n_first - 1)[:n_first] if n_first < len(bounds) else np.arange(len(bounds))
+        scores = np.full(len(bounds), np.nan)
+        scores[first] = self.exact_scores(score, trial_values, first)
+
+        scored = scores[~np.isnan(scores)]
+        kth_best = np.partition(scored, len(scored) - k)[len(scored) - k] if len(scored) >= k else -np.inf
+        rest = np.flatnonzero((bounds >= kth_best) & np.isnan(scores))
+        rest = rest[~np.isin(rest, first)]
+        if len(rest):
+            scores[rest] = self.exact_scores(score, trial_values, rest)
+
+        scored = np.flatnonzero(~np.isnan(scores))
+        # Highest score first, ties in candidate order
+        top = scored[np.lexsort((scored, -scores[scored]))][:k]
+        return top, scores[top]
+
+    def top_k(self, trial_stores, k=5):
+        """
+        The k best control stores per trial store and metric.
+
+        Returns a DataFrame with TRIAL_STORE, metric, rank (1 = best),
+        CONTROL_STORE and control_score, in trial store and metric order.
+        """
+        trial_stores = list(trial_stores)
+        columns = {'TRIAL_STORE': [], 'metric': [], 'rank': [], 'CONTROL_STORE': [], 'control_score': []}
+        ranked = {}
+        for score, metric in self.metrics.items():
+            trial_values = self.matrices[score].reindex(trial_stores).to_numpy(dtype=float)
+            bounds = self.upper_bounds(score, trial_values)
+            for row, trial_store in enumerate(trial_stores):
+                ranked[trial_store, metric] = self.top_k_positions(score, trial_values[row], bounds[row], k)
+
+        for trial_store in trial_stores:
+            for metric in self.metrics.values():
+                positions, scores = ranked[trial_store, metric]
+                columns['TRIAL_STORE'].extend([trial_store] * len(positions))
+                columns['metric'].extend([metric] * len(positions))
+                columns['rank'].extend(range(1, len(positions) + 1))
+                columns['CONTROL_STORE'].extend(self.candidates[positions])
+                columns['control_score'].extend(scores)
+        return pd.DataFrame(columns)
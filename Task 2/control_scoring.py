@@ -0,0 +1,221 @@
+"""
+Vectorized control store scoring.
+
+Pivots monthly_metrics into a STORE_NBR x MONTH_YEAR matrix per metric once and
+scores every trial/candidate pair of every metric with batched NumPy operations
+over one stacked (metric, store, month) array, instead of merging the trial
+store against each candidate store in a loop. Metrics at day or ISO-week grain
+(period_metrics) pivot the same way on their DATE or ISO_WEEK column.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# Pre-trial period used to pick control stores
+PRE_TRIAL_WINDOW = ('2018-07', '2019-01')
+
+# Grain -> period column of a metrics frame; the labels of every grain sort in time order
+PERIOD_COLUMNS = {'day': 'DATE', 'week': 'ISO_WEEK', 'month': 'MONTH_YEAR'}
+
+# Score column -> monthly_metrics column it is computed from
+SCORE_METRICS = {
+    'Sales_Score': 'monthly_sales_revenue',
+    'Customers_Score': 'number_of_customers',
+}
+
+# Ways of turning the mean absolute difference into a magnitude score (see normalised_magnitude_score)
+MAGNITUDE_NORMALISATIONS = ('raw', 'relative', 'minmax')
+
+
+def score_metrics(metrics=None):
+    """
+    Score column -> monthly_metrics column for a list of metric columns.
+
+    None gives SCORE_METRICS. The sales and customer columns keep their
+    SCORE_METRICS score names; any other column is scored as '<column>_Score'.
+    """
+    if metrics is None:
+        return dict(SCORE_METRICS)
+    names = {metric: score for score, metric in SCORE_METRICS.items()}
+    return {names.get(metric, f'{metric}_Score'): metric for metric in metrics}
+
+
+def period_column(metrics):
+    # The period column of a metrics frame: MONTH_YEAR, ISO_WEEK or DATE
+    for column in PERIOD_COLUMNS.values():
+        if column in metrics:
+            return column
+    raise KeyError(f'No period column, expected one of {list(PERIOD_COLUMNS.values())}')
+
+
+def pivot_store_months(monthly_metrics, metric, window=None):
+    # Lay one metric out as a STORE_NBR x period matrix, optionally limited to a window
+    column = period_column(monthly_metrics)
+    if window is not None:
+        monthly_metrics = monthly_metrics[monthly_metrics[column].between(*window)]
+    return monthly_metrics.pivot(index='STORE_NBR', columns=column, values=metric)
+
+
+def build_store_month_matrices(monthly_metrics, metrics=SCORE_METRICS.values()):
+    # Pivot every metric once over the full history so callers can slice windows from it
+    return {metric: pivot_store_months(monthly_metrics, metric) for metric in metrics}
+
+
+def window_columns(matrix, window):
+    # Slice the period columns of a pivoted matrix down to a (start, end) window
+    return matrix.loc[:, matrix.columns.to_series().between(*window).to_numpy()]
+
+
+def stack_store_months(matrices, metrics, stores, window=None):
+    # (metric, store, month) array of the given stores, every metric on the months of the first one
+    windowed = [matrices[metric] if window is None else window_columns(matrices[metric], window) for metric in metrics]
+    months = windowed[0].columns
+    return np.stack([matrix.reindex(index=stores, columns=months).to_numpy(dtype=float) for matrix in windowed])
+
+
+def _masked_pairs(trial_values, candidate_values):
+    # Broadcast (..., trial, month) and (..., candidate, month) to (..., trial, candidate, month)
+    # and keep only months both stores have, mirroring the inner merge on MONTH_YEAR of the
+    # per-store loop
+    x = np.asarray(trial_values, dtype=float)[..., :, None, :]
+    y = np.asarray(candidate_values, dtype=float)[..., None, :, :]
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x = np.where(valid, x, 0.0)
+    y = np.where(valid, y, 0.0)
+    return x, y, valid, valid.sum(axis=-1)
+
+
+def _rowwise_dot(a, b):
+    # Dot product along the last axis via matmul, which sums in the same order as np.dot
+    a, b = np.broadcast_arrays(a, b)
+    return (a[..., None, :] @ b[..., :, None])[..., 0, 0]
+
+
+def _masked_correlation(x, y, valid, count):
+    # Pearson correlation of _masked_pairs output
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_centered = np.where(valid, x - (x.sum(axis=-1) / count)[..., None], 0.0)
+        y_centered = np.where(valid, y - (y.sum(axis=-1) / count)[..., None], 0.0)
+
+        # Same operations as np.corrcoef (dot products, covariance, then divide by
+        # each stddev) so the scores match Series.corr bit for bit
+        scale = 1.0 / (count - 1)
+        cov = _rowwise_dot(x_centered, y_centered) * scale
+        x_std = np.sqrt(_rowwise_dot(x_centered, x_centered) * scale)
+        y_std = np.sqrt(_rowwise_dot(y_centered, y_centered) * scale)
+        corr = cov / x_std / y_std
+
+    return np.clip(corr, -1, 1)
+
+
+def _masked_mean_abs_difference(x, y, valid, count):
+    # Mean absolute difference of _masked_pairs output (masked months are 0 on both sides)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(x - y).sum(axis=-1) / count
+
+
+def pairwise_correlation(trial_values, candidate_values):
+    """
+    Pearson correlation of every trial row against every candidate row.
+
+    Returns a (n_trials, n_candidates) array, or (n_metrics, n_trials,
+    n_candidates) for stacked (n_metrics, stores, months) inputs. Months
+    missing for either store are dropped pairwise, the same way Series.corr
+    treats the merged frame.
+    """
+    return _masked_correlation(*_masked_pairs(trial_values, candidate_values))
+
+
+def pairwise_mean_abs_difference(trial_values, candidate_values):
+    # Mean absolute difference of every trial row against every candidate row
+    return _masked_mean_abs_difference(*_masked_pairs(trial_values, candidate_values))
+
+
+def correlation_score(corr):
+    # Normalize to range [0, 1], higher correlation gets higher score
+    return (corr + 1) / 2
+
+
+def magnitude_score(diff):
+    # Higher score for lower difference
+    return 1 - (diff / (diff + 1))
+
+
+def magnitude_difference(score):
+    # Mean absolute difference a magnitude score was computed from (the inverse of magnitude_score)
+    return (1 - score) / score
+
+
+def normalised_magnitude_score(diff, normalisation='raw', scale=None):
+    """
+    Magnitude score of (..., trial, candidate) mean absolute differences.
+
+    'raw' is magnitude_score of the difference in the metric's own units, which
+    tends to 0 for large stores; 'relative' first divides each difference by
+    scale, the trial store's pre-trial mean (shape (..., trial)); 'minmax'
+    rescales each trial's differences over its candidates so the closest store
+    scores 1 and the furthest 0. Missing differences stay missing.
+    """
+    diff = np.asarray(diff, dtype=float)
+    if normalisation == 'raw':
+        return magnitude_score(diff)
+    if normalisation == 'relative':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return magnitude_score(diff / np.asarray(scale, dtype=float)[..., None])
+    if normalisation == 'minmax':
+        with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+            # Trials without any scored candidate give all-NaN rows
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lowest = np.nanmin(diff, axis=-1, keepdims=True)
+            spread = np.nanmax(diff, axis=-1, keepdims=True) - lowest
+            return np.where(spread > 0, 1 - (diff - lowest) / spread, np.where(np.isnan(diff), np.nan, 1.0))
+    raise ValueError(f'Unknown normalisation {normalisation!r}, expected one of {MAGNITUDE_NORMALISATIONS}')
+
+
+def score_control_pairs(monthly_metrics, trial_stores, window=PRE_TRIAL_WINDOW, candidate_stores=None,
+                        matrices=None, metrics=None):
+    """
+    Score every candidate control store against every trial store in one pass.
+
+    Candidates default to every store in the window that is not a trial store.
+    matrices can hold the output of build_store_month_matrices to reuse pivots
+    that were already built, in which case monthly_metrics is not read.
+    metrics lists the monthly_metrics columns to score (default: every metric
+    of matrices, or SCORE_METRICS); all of them are scored together as one
+    (metric, trial, candidate) array.
+    Returns (scored_corr, scored_mag): two DataFrames indexed by
+    (TRIAL_STORE, STORE_NBR) with one column per score_metrics() score, so that
+    scored_corr.loc[77].reset_index() has the same shape as the old
+    calculate_scored_correlations(pretri_77, pre_monthly_metrics) table.
+    Pairs with no overlapping months in any metric are left out, as before.
+    """
+    trial_stores = list(trial_stores)
+    if metrics is None and matrices is not None:
+        metrics = list(matrices)
+    scores = score_metrics(metrics)
+    if matrices is None:
+        matrices = {metric: pivot_store_months(monthly_metrics, metric, window) for metric in scores.values()}
+    all_stores = matrices[next(iter(scores.values()))].index
+
+    if candidate_stores is None:
+        candidate_stores = all_stores[~all_stores.isin(trial_stores)]
+    candidate_stores = pd.Index(candidate_stores, name='STORE_NBR')
+
+    trial_values = stack_store_months(matrices, scores.values(), trial_stores, window)
+    candidate_values = stack_store_months(matrices, scores.values(), candidate_stores, window)
+    # One (metric, trial, candidate, month) broadcast shared by both scores
+    pairs = _masked_pairs(trial_values, candidate_values)
+    corr_scores = correlation_score(_masked_correlation(*pairs))
+    mag_scores = magnitude_score(_masked_mean_abs_difference(*pairs))
+
+    # Stores that share no months with a trial store had an empty merge and were skipped
+    overlap = (pairs[-1] > 0).any(axis=0).ravel()
+
+    index = pd.MultiIndex.from_product([trial_stores, candidate_stores], names=['TRIAL_STORE', 'STORE_NBR'])
+    n_metrics = len(scores)
+    scored_corr = pd.DataFrame(corr_scores.reshape(n_metrics, -1).T, index=index, columns=list(scores))[overlap]
+    scored_mag = pd.DataFrame(mag_scores.reshape(n_metrics, -1).T, index=index, columns=list(scores))[overlap]
+    return scored_corr, scored_mag
@@ -0,0 +1,242 @@
+"""
+Incremental monthly_metrics aggregation.
+
+MonthlyMetricsStore keeps per-(STORE_NBR, MONTH_YEAR) aggregation state on disk,
+one partition directory per month:
+
+    <state_dir>/MONTH_YEAR=2019-02/metrics.parquet       sales sum and distinct counts per store
+    <state_dir>/MONTH_YEAR=2019-02/customers.parquet     distinct (STORE_NBR, LYLTY_CARD_NBR)
+    <state_dir>/MONTH_YEAR=2019-02/transactions.parquet  distinct (STORE_NBR, TXN_ID)
+    <state_dir>/MONTH_YEAR=2019-02/sources.json          fingerprint of each batch folded in
+
+Appending transactions only touches the months they belong to. Every batch is
+recorded under its source name (or its own fingerprint), so appending the same
+batch again is a no-op, and sync() re-aggregates any month whose rows changed
+since it was last synced (and, given a full snapshot with drop_missing=True,
+deletes the months that are no longer in it). Sales are summed
+with the same Kahan-compensated recurrence as pandas' groupby sum and the
+compensation term is kept with the sum, so a month appended in several batches
+ends up bit-for-bit equal to a single groupby over all of its rows.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+
+
+METRIC_COLUMNS = ['STORE_NBR', 'MONTH_YEAR', 'monthly_sales_revenue', 'number_of_customers', 'total_transactions']
+
+# Columns a batch of transactions is fingerprinted on (MONTH_YEAR is the partition)
+FINGERPRINT_COLUMNS = ['STORE_NBR', 'TOT_SALES', 'LYLTY_CARD_NBR', 'TXN_ID']
+
+# Source name sync() records a month's rows under
+SYNC_SOURCE = 'sync'
+
+
+def rows_fingerprint(rows):
+    """
+    Row count and content hash of a batch of transactions.
+
+    The hash follows the row order, as the compensated sales sums do, and is
+    taken over int64/float64 values so the CSV and Parquet dtypes agree.
+    """
+    values = rows[FINGERPRINT_COLUMNS].astype(
+        {'STORE_NBR': 'int64', 'TOT_SALES': 'float64', 'LYLTY_CARD_NBR': 'int64', 'TXN_ID': 'int64'}
+    )
+    digest = hashlib.sha256(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+    return f'{len(rows)}:{digest.hexdigest()}'
+
+
+def kahan_group_sum(codes, values, n_groups, total=None, compensation=None):
+    """
+    Per-group compensated sum, continuing from an earlier (total, compensation).
+
+    Rows are added to their group in the order given, using the recurrence of
+    pandas' group_sum, so the result matches DataFrame.groupby(...).sum().
+    The groups are processed side by side: one vectorized step per row rank
+    within a group instead of one Python step per row.
+    """
+    total = np.zeros(n_groups) if total is None else np.array(total, dtype=float)
+    compensation = np.zeros(n_groups) if compensation is None else np.array(compensation, dtype=float)
+
+    valid = ~np.isnan(values)
+    codes, values = codes[valid], values[valid]
+    if len(codes) == 0:
+        return total, compensation
+
+    # Lay the rows out as a (group, rank within group) matrix, keeping row order
+    order = np.argsort(codes, kind='stable')
+    codes, values = codes[order], values[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    rank = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    padded = np.zeros((n_groups, counts.max()))
+    padded[codes, rank] = values
+    present = np.zeros((n_groups, counts.max()), dtype=bool)
+    present[codes, rank] = True
+
+    for k in range(counts.max()):
+        y = padded[:, k] - compensation
+        t = total + y
+        step_compensation = t - total - y
+        # An infinite value leaves a NaN compensation, which pandas resets to 0
+        step_compensation[np.isnan(step_compensation)] = 0
+        compensation = np.where(present[:, k], step_compensation, compensation)
+        total = np.where(present[:, k], t, total)
+
+    return total, compensation
+
+
+class MonthlyMetricsStore:
+    """
+    On-disk, month-partitioned state for the Task 2 monthly_metrics frame.
+
+    append() folds new transactions into the partitions of their months
+    (once per source), sync() makes every month it is given equal to exactly
+    those rows, re-aggregating only months whose fingerprint changed (and
+    dropping the months a full snapshot no longer has), and
+    monthly_metrics() assembles the same frame as the groupby in
+    Task2_Data_Analytics.py from the per-month partitions.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+
+    def _partition(self, month):
+        return self.state_dir / f'MONTH_YEAR={month}'
+
+    def months(self):
+        # Months that already have a partition
+        if not self.state_dir.exists():
+            return []
+        return sorted(path.name.split('=', 1)[1] for path in self.state_dir.glob('MONTH_YEAR=*'))
+
+    def sources(self, month):
+        # {source: fingerprint} of the batches folded into a month
+        path = self._partition(month) / 'sources.json'
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def _write_sources(self, month, sources):
+        (self._partition(month) / 'sources.json').write_text(json.dumps(sources, indent=1, sort_keys=True))
+
+    def _clear_month(self, month):
+        # Drop a month's partition so it is aggregated from scratch
+        partition = self._partition(month)
+        if partition.exists():
+            for path in partition.iterdir():
+                path.unlink()
+            partition.rmdir()
+
+    def _update_month(self, month, rows):
+        partition = self._partition(month)
+        if partition.exists():
+            metrics = pd.read_parquet(partition / 'metrics.parquet')
+            customers = pd.read_parquet(partition / 'customers.parquet')
+            transactions = pd.read_parquet(partition / 'transactions.parquet')
+        else:
+            partition.mkdir(parents=True)
+            metrics = pd.DataFrame({'STORE_NBR': pd.Series(dtype='int64'), 'sales_sum': pd.Series(dtype=float),
+                                    'sales_compensation': pd.Series(dtype=float)})
+            customers = pd.DataFrame(columns=['STORE_NBR', 'LYLTY_CARD_NBR'], dtype='int64')
+            transactions = pd.DataFrame(columns=['STORE_NBR', 'TXN_ID'], dtype='int64')
+
+        # Continue the compensated sales sums of every store seen this month
+        stores = pd.Index(np.union1d(metrics['STORE_NBR'], rows['STORE_NBR']), name='STORE_NBR')
+        previous = metrics.set_index('STORE_NBR').reindex(stores, fill_value=0.0)
+        sales_sum, sales_compensation = kahan_group_sum(
+            stores.get_indexer(rows['STORE_NBR']), rows['TOT_SALES'].to_numpy(dtype=float), len(stores),
+            previous['sales_sum'].to_numpy(), previous['sales_compensation'].to_numpy(),
+        )
+
+        # Exact distinct sets, merged with what earlier batches of this month already had
+        customers = pd.concat([customers, rows[['STORE_NBR', 'LYLTY_CARD_NBR']]]).drop_duplicates()
+        transactions = pd.concat([transactions, rows[['STORE_NBR', 'TXN_ID']]]).drop_duplicates()
+
+        metrics = pd.DataFrame({
+            'STORE_NBR': stores,
+            'sales_sum': sales_sum,
+            'sales_compensation': sales_compensation,
+            'number_of_customers': customers.groupby('STORE_NBR').size().reindex(stores, fill_value=0).to_numpy(),
+            'total_transactions': transactions.groupby('STORE_NBR').size().reindex(stores, fill_value=0).to_numpy(),
+        })
+        metrics.to_parquet(partition / 'metrics.parquet', index=False)
+        customers.astype('int64').to_parquet(partition / 'customers.parquet', index=False)
+        transactions.astype('int64').to_parquet(partition / 'transactions.parquet', index=False)
+
+    @timed('monthly_metrics_append')
+    def append(self, transactions, source=None):
+        """
+        Fold transactions (STORE_NBR, MONTH_YEAR, TOT_SALES, LYLTY_CARD_NBR, TXN_ID)
+        into the state. Only the partitions of the months present are rewritten.
+
+        Each month's rows are recorded under source (e.g. the file they came
+        from; by default their own fingerprint), and a month that already holds
+        the same rows from that source is skipped, so appending a batch twice
+        counts it once. A source whose rows changed since they were appended
+        raises ValueError: sync() the month's full rows instead.
+        Returns the list of updated months.
+        """
+        months = transactions['MONTH_YEAR'].astype(str)
+        updated = []
+        for month, rows in transactions.groupby(months.to_numpy(), sort=True):
+            fingerprint = rows_fingerprint(rows)
+            key = fingerprint if source is None else str(source)
+            sources = self.sources(month)
+            if key in sources:
+                if sources[key] != fingerprint:
+                    raise ValueError(f'{key} changed since it was appended to {month}; sync the month instead')
+                continue
+            self._update_month(month, rows)
+            self._write_sources(month, {**sources, key: fingerprint})
+            updated.append(month)
+        return updated
+
+    @timed('monthly_metrics_sync')
+    def sync(self, transactions, drop_missing=False):
+        """
+        Make every month present in transactions hold exactly its rows there.
+
+        Months whose fingerprint (row count and content hash) matches the one
+        recorded by the last sync are left alone; new, partly loaded or changed
+        months are re-aggregated from scratch. Months absent from transactions
+        are kept, unless drop_missing is set: then transactions is the full
+        snapshot and the partitions of every other month are deleted. Returns
+        the list of updated (and deleted) months.
+        """
+        months = transactions['MONTH_YEAR'].astype(str)
+        updated = []
+        if drop_missing:
+            present = set(months.unique())
+            for month in self.months():
+                if month not in present:
+                    self._clear_month(month)
+                    updated.append(month)
+        for month, rows in transactions.groupby(months.to_numpy(), sort=True):
+            fingerprint = rows_fingerprint(rows)
+            if self.sources(month) == {SYNC_SOURCE: fingerprint}:
+                continue
+            self._clear_month(month)
+            self._update_month(month, rows)
+            self._write_sources(month, {SYNC_SOURCE: fingerprint})
+            updated.append(month)
+        return sorted(updated)
+
+    @timed('monthly_metrics')
+    def monthly_metrics(self):
+        # Assemble monthly_metrics from the per-month partitions, sorted like the groupby output
+        frames = []
+        for month in self.months():
+            metrics = pd.read_parquet(self._partition(month) / 'metrics.parquet')
+            metrics.insert(1, 'MONTH_YEAR', month)
+            frames.append(metrics)
+        if not frames:
+            return pd.DataFrame(columns=METRIC_COLUMNS)
+
+        metrics = pd.concat(frames, ignore_index=True).rename(columns={'sales_sum': 'monthly_sales_revenue'})
+        metrics = metrics.sort_values(['STORE_NBR', 'MONTH_YEAR']).reset_index(drop=True)
+        return metrics[METRIC_COLUMNS]
@@ -0,0 +1,399 @@
+"""
+Generic multi-trial evaluation.
+
+evaluate_trials() picks a control store for each trial store and measures the
+uplift against the scaled control, sharing one set of store x month matrices,
+one scoring pass and one uplift pass across every trial.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from control_index import ControlCandidateIndex
+from control_scoring import (
+    MAGNITUDE_NORMALISATIONS, PERIOD_COLUMNS, PRE_TRIAL_WINDOW, build_store_month_matrices, magnitude_difference,
+    normalised_magnitude_score, score_control_pairs, score_metrics, window_columns,
+)
+from instrumentation import timed
+
+
+# Trial period used when a trial does not give its own
+TRIAL_WINDOW = ('2019-02', '2019-04')
+
+# Correlation weights tried by sweep_controls; the magnitude score gets 1 - weight
+SWEEP_WEIGHTS = tuple(np.round(np.linspace(0, 1, 11), 2))
+
+# MONTH_YEAR is the period column; results at day or week grain have DATE or ISO_WEEK in its place
+RESULT_COLUMNS = [
+    'TRIAL_STORE', 'metric', 'CONTROL_STORE', 'control_score', 'scaling_factor', 'MONTH_YEAR', 'period',
+    'trial_value', 'control_value', 'scaled_control', 'percentage_diff',
+]
+
+
+def normalize_trials(trials):
+    # Accept bare store numbers or dicts and fill in the default windows
+    normalized = []
+    for trial in trials:
+        if not isinstance(trial, dict):
+            trial = {'store': trial}
+        normalized.append({
+            'store': trial['store'],
+            'pre_window': tuple(trial.get('pre_window', PRE_TRIAL_WINDOW)),
+            'trial_window': tuple(trial.get('trial_window', TRIAL_WINDOW)),
+        })
+
+    stores = [trial['store'] for trial in normalized]
+    if len(set(stores)) != len(stores):
+        raise ValueError('Each trial store can only be evaluated once per call')
+    return normalized
+
+
+def group_trials(trials, *keys):
+    # Group trials that share the same windows so they can be computed as one batch
+    groups = {}
+    for trial in trials:
+        groups.setdefault(tuple(trial[key] for key in keys), []).append(trial)
+    return groups
+
+
+def _in_trial_order(frame, trials):
+    # Restore the order the trials were given in, then the order the metrics were computed in
+    order = {'TRIAL_STORE': {trial['store']: position for position, trial in enumerate(trials)}}
+    if 'metric' in frame:
+        order['metric'] = {metric: position for position, metric in enumerate(frame['metric'].unique())}
+    return frame.sort_values(
+        [column for column in ['TRIAL_STORE', 'metric', 'rank', *PERIOD_COLUMNS.values()] if column in frame],
+        key=lambda column: column.map(order[column.name]) if column.name in order else column,
+    ).reset_index(drop=True)
+
+
+def candidate_stores(matrices, trials):
+    # Every store except the trial stores can be a control
+    all_stores = next(iter(matrices.values())).index
+    return all_stores[~all_stores.isin([trial['store'] for trial in trials])]
+
+
+def score_candidates(matrices, trials, candidates):
+    """
+    Score every candidate store against each trial store over its pre-trial window.
+
+    Trials that share a pre-trial window are scored together in one batch.
+    Returns {'correlation', 'magnitude', 'composite'} tables indexed by
+    (TRIAL_STORE, STORE_NBR) with one column per score; the composite score is
+    the average of the correlation and magnitude scores.
+    """
+    tables = {'correlation': [], 'magnitude': [], 'composite': []}
+    for (pre_window,), group in group_trials(trials, 'pre_window').items():
+        scored_corr, scored_mag = score_control_pairs(
+            None, [trial['store'] for trial in group], window=pre_window, candidate_stores=candidates,
+            matrices=matrices,
+        )
+        tables['correlation'].append(scored_corr)
+        tables['magnitude'].append(scored_mag)
+        tables['composite'].append((scored_corr + scored_mag) / 2)
+    return {name: pd.concat(frames) for name, frames in tables.items()}
+
+
+def pick_controls(composite, trials, metrics=None):
+    # Best control store per trial and metric from a composite score table of the metrics scored
+    controls = []
+    for score, metric in score_metrics(metrics).items():
+        # idxmax keeps the first of tied stores, like nlargest(1)
+        best = composite[score].groupby(level='TRIAL_STORE').idxmax()
+        controls.append(pd.DataFrame({
+            'TRIAL_STORE': best.index,
+            'metric': metric,
+            'CONTROL_STORE': [store_nbr for _, store_nbr in best],
+            'control_score': composite[score].loc[best.to_list()].to_numpy(),
+        }))
+    return _in_trial_order(pd.concat(controls, ignore_index=True), trials)
+
+
+@timed('scoring')
+def select_controls(matrices, trials):
+    """
+    Pick the best control store per trial and metric from the composite score.
+
+    Every metric of matrices is scored, all of them in one stacked array
+    operation. The composite score is the average of the correlation and
+    magnitude scores.
+    Trials that share a pre-trial window are scored together in one batch, and
+    no trial store is ever used as a control for another trial.
+    Returns a DataFrame with TRIAL_STORE, metric, CONTROL_STORE and control_score.
+    """
+    scores = score_candidates(matrices, trials, candidate_stores(matrices, trials))
+    return pick_controls(scores['composite'], trials, list(matrices))
+
+
+@timed('scoring')
+def top_k_controls(matrices, trials, k=5):
+    """
+    The k best control stores per trial and metric, ranked by composite score.
+
+    Same stores and scores as ranking the full score_candidates() tables, but
+    each pre-trial window gets a ControlCandidateIndex that prunes most
+    candidates before they are scored exactly.
+    Returns a DataFrame with TRIAL_STORE, metric, rank, CONTROL_STORE and control_score.
+    """
+    candidates = candidate_stores(matrices, trials)
+    controls = []
+    for (pre_window,), group in group_trials(trials, 'pre_window').items():
+        index = ControlCandidateIndex(matrices, pre_window, candidates)
+        controls.append(index.top_k([trial['store'] for trial in group], k))
+    return _in_trial_order(pd.concat(controls, ignore_index=True), trials)
+
+
+def _top_k_last_axis(values, k):
+    """
+    The k largest entries along the last axis of values, ties in position order.
+
+    Returns (rows, ranks, positions): the flat index of the leading axes, the
+    0-based rank and the last-axis position of each kept entry. NaN entries
+    are never returned, so rows with fewer than k scores keep fewer entries.
+    """
+    flat = values.reshape(-1, values.shape[-1])
+    filled = np.where(np.isnan(flat), -np.inf, flat)
+    k = min(k, flat.shape[1])
+    # Only entries at least as large as each row's k-th largest can make its top k
+    kth = np.partition(filled, flat.shape[1] - k, axis=1)[:, flat.shape[1] - k, None]
+    rows, positions = np.nonzero((filled >= kth) & ~np.isnan(flat))
+    order = np.lexsort((positions, -flat[rows, positions], rows))
+    rows, positions = rows[order], positions[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = ranks < k
+    return rows[keep], ranks[keep], positions[keep]
+
+
+def _score_array(table, trial_stores, candidates):
+    # (trial, candidate) array of one score table column, NaN for pairs without a score
+    return table.unstack('STORE_NBR').reindex(index=trial_stores, columns=candidates).to_numpy(dtype=float)
+
+
+@timed('scoring')
+def sweep_controls(matrices, trials, weights=SWEEP_WEIGHTS, normalisations=MAGNITUDE_NORMALISATIONS, k=1,
+                   scores=None):
+    """
+    Ranked control stores for every correlation weight and magnitude normalisation.
+
+    The composite score of a configuration is weight * correlation score +
+    (1 - weight) * magnitude score, with the magnitude score normalised as in
+    normalised_magnitude_score(). scores are the score_candidates() tables
+    (computed when not given); every configuration is then one slice of a
+    single broadcast (weight, normalisation, trial, candidate) array per metric.
+    Returns weight, normalisation, TRIAL_STORE, metric, rank, CONTROL_STORE and
+    control_score; weight 0.5 with 'raw' ranks like select_controls().
+    """
+    trials = normalize_trials(trials)
+    trial_stores = [trial['store'] for trial in trials]
+    candidates = candidate_stores(matrices, trials)
+    if scores is None:
+        scores = score_candidates(matrices, trials, candidates)
+
+    weights = np.asarray(weights, dtype=float)
+    frames = []
+    for score, metric in score_metrics(list(matrices)).items():
+        correlation = _score_array(scores['correlation'][score], trial_stores, candidates)
+        magnitude = _score_array(scores['magnitude'][score], trial_stores, candidates)
+
+        # Pre-trial mean of each trial store, the scale of the 'relative' normalisation
+        scale = pd.Series(np.nan, index=trial_stores)
+        for (pre_window,), group in group_trials(trials, 'pre_window').items():
+            stores = [trial['store'] for trial in group]
+            pre_values = window_columns(matrices[metric], pre_window).reindex(stores).to_numpy(dtype=float)
+            scale[stores] = np.nanmean(pre_values, axis=1)
+        scale = scale.to_numpy()
+        magnitudes = np.stack([
+            magnitude if normalisation == 'raw'
+            else normalised_magnitude_score(magnitude_difference(magnitude), normalisation, scale)
+            for normalisation in normalisations
+        ])
+        composite = (weights[:, None, None, None] * correlation[None, None]
+                     + (1 - weights)[:, None, None, None] * magnitudes[None])
+
+        # Highest score first, ties in candidate order, like nlargest
+        rows, ranks, positions = _top_k_last_axis(composite, k)
+        weight, normalisation, trial = np.unravel_index(rows, composite.shape[:-1])
+        frames.append(pd.DataFrame({
+            'weight': weights[weight],
+            'normalisation': np.asarray(normalisations)[normalisation],
+            'TRIAL_STORE': np.asarray(trial_stores)[trial],
+            'metric': metric,
+            'rank': ranks + 1,
+            'CONTROL_STORE': candidates[positions],
+            'control_score': composite.reshape(-1, composite.shape[-1])[rows, positions],
+        }))
+
+    # One block per configuration, in the order of weights and normalisations
+    sweep = _in_trial_order(pd.concat(frames, ignore_index=True), trials)
+    positions = {normalisation: position for position, normalisation in enumerate(normalisations)}
+    return sweep.sort_values(
+        ['weight', 'normalisation'], kind='stable',
+        key=lambda column: column.map(positions) if column.name == 'normalisation' else column,
+    ).reset_index(drop=True)
+
+
+@timed('uplift')
+def compute_uplift(matrices, trials, controls):
+    """
+    Scale each control to its trial store and measure the difference month by month.
+
+    The scaling factor is the ratio of the trial and control pre-trial means.
+    Trials that share windows are computed together as array operations.
+    Returns a tidy DataFrame with one row per trial, metric and month (or
+    period, named after the matrices' period column).
+    """
+    results = []
+    period_column = next(iter(matrices.values())).columns.name
+    for (pre_window, trial_window), group in group_trials(trials, 'pre_window', 'trial_window').items():
+        stores = [trial['store'] for trial in group]
+
+        for metric, matrix in matrices.items():
+            chosen = controls[controls['metric'] == metric].set_index('TRIAL_STORE').loc[stores]
+
+            trial_values = matrix.reindex(stores).to_numpy(dtype=float)
+            control_values = matrix.reindex(chosen['CONTROL_STORE']).to_numpy(dtype=float)
+
+            # Pre-trial means of the trial and control stores give the scaling factor
+            pre_trial = window_columns(matrix, pre_window).columns
+            pre_positions = matrix.columns.get_indexer(pre_trial)
+            trial_means = np.nanmean(trial_values[:, pre_positions], axis=1)
+            control_means = np.nanmean(control_values[:, pre_positions], axis=1)
+            scaling_factor = trial_means / control_means
+
+            scaled_control = control_values * scaling_factor[:, None]
+            percentage_diff = (trial_values - scaled_control) / scaled_control * 100
+
+            months = matrix.columns.to_series()
+            period = np.select(
+                [months.between(*pre_window), months.between(*trial_window)], ['pre', 'trial'], 'other'
+            )
+
+            n_trials, n_months = trial_values.shape
+            results.append(pd.DataFrame({
+                'TRIAL_STORE': np.repeat(stores, n_months),
+                'metric': metric,
+                'CONTROL_STORE': np.repeat(chosen['CONTROL_STORE'].to_numpy(), n_months),
+                'control_score': np.repeat(chosen['control_score'].to_numpy(), n_months),
+                'scaling_factor': np.repeat(scaling_factor, n_months),
+                period_column: np.tile(matrix.columns.to_numpy(), n_trials),
+                'period': np.tile(period, n_trials),
+                'trial_value': trial_values.ravel(),
+                'control_value': control_values.ravel(),
+                'scaled_control': scaled_control.ravel(),
+                'percentage_diff': percentage_diff.ravel(),
+            }))
+
+    columns = [period_column if column == 'MONTH_YEAR' else column for column in RESULT_COLUMNS]
+    return _in_trial_order(pd.concat(results, ignore_index=True)[columns], trials)
+
+
+# Matrices handed to each pool worker once by _init_worker
+_worker_matrices = None
+
+
+def _init_worker(matrices):
+    # With the fork start method the matrices are inherited copy-on-write; with spawn
+    # they are pickled once per worker instead of once per trial
+    global _worker_matrices
+    _worker_matrices = matrices
+
+
+@timed('plotting')
+def render_trial_figures(trial_results, output_dir, n_jobs=1):
+    # Save the pre-trial and trial comparison figures for every trial store and metric,
+    # skipping figures whose results are unchanged since they were last saved
+    from chart_rendering import render_charts
+    from trial_plots import trial_figure_specs
+
+    return render_charts(trial_figure_specs(trial_results, output_dir), n_jobs=n_jobs)
+
+
+def _evaluate_cached_trials(cache, matrices, trials):
+    # Batched control selection, then scaling factors and comparison frames, each stage looked up in the cache
+    controls = cache.cached('controls', select_controls, matrices, trials)
+    return cache.cached('uplift', compute_uplift, matrices, trials, controls)
+
+
+def _evaluate_trial_chain(trial, controls, output_dir):
+    # Uplift and figures of a single trial, run inside a pool worker
+    trial_results = compute_uplift(_worker_matrices, [trial], controls)
+    if output_dir is not None:
+        render_trial_figures(trial_results, output_dir)
+    return trial_results
+
+
+@timed('evaluate_trials')
+def evaluate_trials(monthly_metrics, trials, n_jobs=1, output_dir=None, cache=None, metrics=None):
+    """
+    Evaluate any number of trial stores against automatically selected controls.
+
+    trials is a list of store numbers or dicts with 'store' and optional
+    'pre_window' / 'trial_window' (MONTH_YEAR start and end, inclusive).
+    monthly_metrics can also be period_metrics output at day or ISO-week
+    grain, with the windows given as DATE or ISO_WEEK labels.
+    metrics lists the monthly_metrics columns to match and measure (default:
+    the SCORE_METRICS sales and customer columns); any numeric column works.
+    Returns one tidy DataFrame (see RESULT_COLUMNS) with a row per trial store,
+    metric and month; summarize_uplift() reduces it to one row per trial.
+
+    Control selection always runs as one batched pass. With n_jobs > 1 (or -1 for
+    every core) the per-trial uplift and figure rendering are fanned out over a
+    process pool; results come back in the order the trials were given.
+    If output_dir is set, each trial's comparison figures are saved there.
+
+    With a StageCache (see stage_cache.py) the controls of the batched
+    selection and the uplift are cached on the store x month matrices and the
+    trials, so a re-run with the same inputs skips both.
+    """
+    trials = normalize_trials(trials)
+    matrices = build_store_month_matrices(monthly_metrics, score_metrics(metrics).values())
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    if cache is not None:
+        trial_results = _evaluate_cached_trials(cache, matrices, trials)
+        if output_dir is not None:
+            render_trial_figures(trial_results, output_dir, n_jobs=n_jobs)
+        return trial_results
+
+    controls = select_controls(matrices, trials)
+    if n_jobs is None or n_jobs <= 1 or len(trials) <= 1:
+        trial_results = compute_uplift(matrices, trials, controls)
+        if output_dir is not None:
+            render_trial_figures(trial_results, output_dir)
+        return trial_results
+
+    trial_controls = [controls[controls['TRIAL_STORE'] == trial['store']] for trial in trials]
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(trials)), initializer=_init_worker,
+                             initargs=(matrices,)) as executor:
+        # map yields in submission order, so the output does not depend on scheduling
+        trial_results = list(executor.map(
+            _evaluate_trial_chain, trials, trial_controls, [output_dir] * len(trials)
+        ))
+    return pd.concat(trial_results, ignore_index=True)
+
+
+def summarize_uplift(results):
+    # Average and total uplift over the trial period, one row per trial store and metric. The totals
+    # only cover periods with both a trial value and a scaled control (weekly series have missing
+    # weeks outside a store's trading span), so they compare the same periods
+    trial_period = results[results['period'] == 'trial']
+    paired = trial_period[['trial_value', 'scaled_control']].notna().all(axis=1)
+    trial_period = trial_period.assign(
+        trial_value=trial_period['trial_value'].where(paired),
+        scaled_control=trial_period['scaled_control'].where(paired),
+    )
+    summary = trial_period.groupby(['TRIAL_STORE', 'metric'], sort=False).agg(
+        CONTROL_STORE=('CONTROL_STORE', 'first'),
+        scaling_factor=('scaling_factor', 'first'),
+        avg_percentage_diff=('percentage_diff', 'mean'),
+        total_trial=('trial_value', 'sum'),
+        total_scaled_control=('scaled_control', 'sum'),
+    ).reset_index()
+    summary['total_percentage_diff'] = (
+        (summary['total_trial'] - summary['total_scaled_control']) / summary['total_scaled_control'] * 100
+    )
+    return summary
@@ -0,0 +1,174 @@
+"""
+Figures for the trial evaluation results returned by evaluate_trials().
+
+The draw_* functions plot onto a given Axes; trial_figure_specs() turns them
+into chart specs for chart_rendering.render_charts(), and the plot_* functions
+draw and save a single figure with pyplot for interactive use.
+"""
+
+import os
+
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from chart_rendering import chart_spec
+from instrumentation import timed
+
+
+# metric -> (name used in titles, y axis label, figure file prefix)
+METRIC_LABELS = {
+    'monthly_sales_revenue': ('Sales', 'Total Sales ($)', 'sales'),
+    'number_of_customers': ('Customers', 'Number of Customers', 'customer'),
+    'total_transactions': ('Transactions', 'Number of Transactions', 'transaction'),
+    'avg_transactions_per_customer': ('Transactions per Customer', 'Transactions per Customer', 'transactions_per_customer'),
+}
+
+
+def metric_labels(metric):
+    # Labels of a metric; other monthly_metrics columns are named after the column
+    return METRIC_LABELS.get(metric, (metric.replace('_', ' ').title(), metric.replace('_', ' ').title(), metric))
+
+
+FIGSIZE = (14, 7)
+
+# Most dated ticks on the x axis of a day or week grain figure
+MAX_PERIOD_TICKS = 24
+
+
+def _months(trial_result):
+    # Convert the period column (MONTH_YEAR, ISO_WEEK or DATE) to datetime for plotting
+    if 'MONTH_YEAR' in trial_result:
+        return pd.to_datetime(trial_result['MONTH_YEAR'] + '-01')
+    if 'ISO_WEEK' in trial_result:
+        # An ISO week is plotted at its Monday
+        return pd.to_datetime(trial_result['ISO_WEEK'] + '-1', format='%G-W%V-%u')
+    return pd.to_datetime(trial_result['DATE'])
+
+
+def _period_name(trial_result):
+    # x axis label of the grain of trial_result
+    if 'ISO_WEEK' in trial_result:
+        return 'Week'
+    return 'Date' if 'DATE' in trial_result else 'Month'
+
+
+def _format_month_axis(ax, months):
+    # Format x-axis ticks as dates: every month name at month grain, dated ticks at finer grains
+    if (months.dt.day == 1).all() and months.dt.to_period('M').is_unique:
+        ax.set_xticks(months, months.dt.strftime('%B %Y'), rotation=45)
+        return
+    ticks = months.iloc[::max(1, -(-len(months) // MAX_PERIOD_TICKS))]
+    ax.set_xticks(ticks, ticks.dt.strftime('%d %b %Y'), rotation=45)
+
+
+def _finish_axes(ax, title, ylabel, months, xlabel='Month'):
+    ax.set_title(title, fontsize=16)
+    ax.set_xlabel(xlabel, fontsize=12)
+    ax.set_ylabel(ylabel, fontsize=12)
+    ax.grid(True, alpha=0.3)
+    ax.legend(fontsize=12)
+    _format_month_axis(ax, months)
+
+
+def pretrial_figure_path(trial_result, output_dir):
+    _, _, prefix = metric_labels(trial_result['metric'].iloc[0])
+    return os.path.join(output_dir, f"pretrial_{prefix}_comparison_store_{trial_result['TRIAL_STORE'].iloc[0]}.png")
+
+
+def trial_figure_path(trial_result, output_dir):
+    name, _, _ = metric_labels(trial_result['metric'].iloc[0])
+    name = name.lower().replace(' ', '_')
+    return os.path.join(output_dir, f"trial_vs_scaled_control_{name}_{trial_result['TRIAL_STORE'].iloc[0]}.png")
+
+
+def draw_pretrial_comparison(ax, trial_result):
+    """
+    Plot the trial store against its (unscaled) control over the pre-trial period.
+
+    trial_result holds the evaluate_trials() rows of one trial store and metric.
+    """
+    pretrial = trial_result[trial_result['period'] == 'pre']
+    trial_store = trial_result['TRIAL_STORE'].iloc[0]
+    control_store = trial_result['CONTROL_STORE'].iloc[0]
+    name, ylabel, _ = metric_labels(trial_result['metric'].iloc[0])
+    months = _months(pretrial)
+
+    ax.plot(months, pretrial['trial_value'],
+            marker='o', linestyle='-', color='blue', linewidth=2, label=f'Trial Store {trial_store}')
+    ax.plot(months, pretrial['control_value'],
+            marker='s', linestyle='--', color='orange', linewidth=2, label=f'Control Store {control_store}')
+
+    _finish_axes(ax, f'Pre-trial {name} Comparison: Trial Store {trial_store} vs Control Store {control_store}',
+                 ylabel, months, _period_name(trial_result))
+
+
+def draw_trial_comparison(ax, trial_result, band_label='Predicted Trial 5th-95th Percentile'):
+    """
+    Plot the trial store against its scaled control over the whole period.
+
+    When trial_result carries the null_lower / null_upper columns of
+    trial_significance(), the bootstrap band of the trial store's value
+    predicted without a trial effect is shaded.
+    """
+    trial_store = trial_result['TRIAL_STORE'].iloc[0]
+    control_store = trial_result['CONTROL_STORE'].iloc[0]
+    name, ylabel, _ = metric_labels(trial_result['metric'].iloc[0])
+    months = _months(trial_result)
+    trial_months = months[(trial_result['period'] == 'trial').to_numpy()]
+
+    ax.plot(months, trial_result['trial_value'],
+            marker='o', linestyle='-', color='blue', linewidth=2, label=f'Trial Store {trial_store}')
+    ax.plot(months, trial_result['scaled_control'],
+            marker='s', linestyle='--', color='red', linewidth=2, label=f'Control Store {control_store} (Scaled)')
+
+    # Bootstrap band of the trial store's value under no trial effect (see trial_significance.py)
+    if 'null_lower' in trial_result:
+        ax.fill_between(months, trial_result['null_lower'], trial_result['null_upper'],
+                        color='gray', alpha=0.2, label=band_label)
+
+    # Add vertical lines to indicate start and end of trial period
+    ax.axvline(x=trial_months.min(), color='green', linestyle='-', alpha=0.5, label='Trial Start')
+    ax.axvline(x=trial_months.max(), color='purple', linestyle='-', alpha=0.5, label='Trial End')
+
+    _finish_axes(ax, f'Comparison of Trial Store {trial_store} vs Scaled Control Store {control_store} - {name}',
+                 ylabel, months, _period_name(trial_result))
+
+
+def trial_figure_specs(trial_results, output_dir='visualizations'):
+    # Chart specs of both comparison figures for every trial store and metric in trial_results
+    specs = []
+    for _, trial_result in trial_results.groupby(['TRIAL_STORE', 'metric'], sort=False):
+        trial_result = trial_result.reset_index(drop=True)
+        specs.append(chart_spec(pretrial_figure_path(trial_result, output_dir), draw_pretrial_comparison,
+                                trial_result, figsize=FIGSIZE, tight_layout=True))
+        specs.append(chart_spec(trial_figure_path(trial_result, output_dir), draw_trial_comparison,
+                                trial_result, figsize=FIGSIZE, tight_layout=True))
+    return specs
+
+
+@timed('plot_pretrial_comparison')
+def plot_pretrial_comparison(trial_result, output_dir='visualizations'):
+    """
+    Draw and save the pre-trial comparison of one trial store and metric with pyplot.
+
+    Saves pretrial_<metric>_comparison_store_<store>.png and returns the figure.
+    """
+    fig, ax = plt.subplots(figsize=FIGSIZE)
+    draw_pretrial_comparison(ax, trial_result)
+    fig.tight_layout()
+    fig.savefig(pretrial_figure_path(trial_result, output_dir))
+    return fig
+
+
+@timed('plot_trial_comparison')
+def plot_trial_comparison(trial_result, output_dir='visualizations'):
+    """
+    Draw and save the trial vs scaled control comparison with pyplot.
+
+    Saves trial_vs_scaled_control_<metric>_<store>.png and returns the figure.
+    """
+    fig, ax = plt.subplots(figsize=FIGSIZE)
+    draw_trial_comparison(ax, trial_result)
+    fig.tight_layout()
+    fig.savefig(trial_figure_path(trial_result, output_dir))
+    return fig
@@ -0,0 +1,176 @@
+"""
+Bootstrap significance of trial uplift.
+
+For every trial store and metric the null hypothesis is "no trial effect": the
+trial store follows its scaled control in the trial months the same way it did
+in the pre-trial months. Each resample redraws the pre-trial months with
+replacement, re-estimates the scaling factor from them, and predicts every
+month as the rescaled control plus a percentage residual drawn from the
+resampled pre-trial fit. The predictions give
+
+- a real percentile band for the trial store's value in every month,
+- a p-value per month and for the trial-period total: the share of resamples
+  whose prediction is at least as extreme as the observed trial value.
+
+All resamples are drawn as arrays of shape (series, resamples, months) from one
+seeded generator, so results are reproducible and there is no Python loop per
+resample.
+
+Limitation: the null distribution can only be as rich as the pre-trial fit. With
+the 7 pre-trial months of the QVI trials each prediction draws from at most 7
+residuals, so the band is coarse and an observed month outside the spread of
+those residuals gets the smallest possible p-value, 1 / (n_resamples + 1)
+(about 0.0001), while one inside it gets a large one, up to 1.0. The monthly
+p-values therefore mostly separate "outside the pre-trial spread" from
+"inside it" and are not calibrated significance levels; the summary reports
+the number of pre-trial periods behind each series so this can be judged.
+"""
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+
+
+N_RESAMPLES = 10_000
+
+# Lower and upper percentile of the null band
+BAND_PERCENTILES = (5, 95)
+
+# Series resampled together, which bounds the memory of the (series, resamples, months) arrays
+CHUNK_SERIES = 8
+
+SERIES_KEYS = ['TRIAL_STORE', 'metric']
+
+
+def _compact_positions(mask):
+    # Positions of the True entries of each row moved to the front, and how many there are
+    order = np.argsort(~mask, axis=1, kind='stable')
+    return order, mask.sum(axis=1)
+
+
+def _draw(rng, counts, size):
+    # Uniform draws from range(counts[i]) for each series i, of shape (len(counts),) + size
+    uniform = rng.random((len(counts),) + size)
+    return np.minimum((uniform * counts.reshape((-1,) + (1,) * len(size))).astype(np.intp),
+                      np.maximum(counts - 1, 0).reshape((-1,) + (1,) * len(size)))
+
+
+def bootstrap_predictions(trial_values, control_values, pre_mask, n_resamples, rng):
+    """
+    Null predictions of the trial values, shape (series, months, resamples).
+
+    trial_values and control_values are (series, months) arrays; pre_mask marks
+    the pre-trial months of each series. Months with missing values are left
+    out of the resampling.
+    """
+    n_series, n_months = trial_values.shape
+    valid = pre_mask & ~np.isnan(trial_values) & ~np.isnan(control_values)
+    order, n_valid = _compact_positions(valid)
+    n_pre = max(int(n_valid.max()), 1)
+    pre_trial = np.take_along_axis(trial_values, order[:, :n_pre], axis=1)
+    pre_control = np.take_along_axis(control_values, order[:, :n_pre], axis=1)
+
+    # Resample the pre-trial months and re-estimate the scaling factor from each resample
+    picks = _draw(rng, n_valid, (n_resamples, n_pre))
+    used = np.arange(n_pre) < n_valid[:, None, None]
+    boot_trial = np.take_along_axis(pre_trial[:, None, :], picks, axis=2)
+    boot_control = np.take_along_axis(pre_control[:, None, :], picks, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaling_factor = (np.where(used, boot_trial, 0).sum(axis=2) / np.where(used, boot_control, 0).sum(axis=2))
+        residuals = (boot_trial - boot_control * scaling_factor[..., None]) / (boot_control * scaling_factor[..., None])
+
+    # One residual of the resampled pre-trial fit per predicted month
+    residual_picks = _draw(rng, n_valid, (n_resamples, n_months))
+    drawn = np.take_along_axis(residuals, residual_picks, axis=2)
+    predicted = control_values[:, None, :] * scaling_factor[..., None] * (1 + drawn)
+    # Resamples last, so the percentiles are taken over contiguous memory
+    return np.ascontiguousarray(predicted.transpose(0, 2, 1))
+
+
+def _percentile(values, q, axis):
+    # np.nanpercentile works column by column; only pay for it when there are missing values
+    if np.isnan(values).any():
+        return np.nanpercentile(values, q, axis=axis)
+    return np.percentile(values, q, axis=axis)
+
+
+def _p_values(predicted, observed, alternative):
+    # Share of resamples at least as extreme as the observed value, with the +1 correction
+    if alternative == 'greater':
+        extreme = predicted >= observed
+    elif alternative == 'less':
+        extreme = predicted <= observed
+    elif alternative == 'two-sided':
+        center = _percentile(predicted, 50, axis=-1)[..., None]
+        extreme = np.abs(predicted - center) >= np.abs(observed - center)
+    else:
+        raise ValueError(f"alternative must be 'greater', 'less' or 'two-sided', not {alternative!r}")
+    p_values = (1 + extreme.sum(axis=-1)) / (1 + predicted.shape[-1])
+    return np.where(np.isnan(observed[..., 0]), np.nan, p_values)
+
+
+@timed('significance')
+def trial_significance(trial_results, n_resamples=N_RESAMPLES, percentiles=BAND_PERCENTILES, seed=0,
+                       alternative='greater'):
+    """
+    Bootstrap percentile bands and p-values for the evaluate_trials() results.
+
+    Returns (monthly, summary):
+    - monthly is trial_results with null_lower / null_upper (the percentiles
+      of the predicted trial value under no trial effect) and p_value per month,
+    - summary has one row per trial store and metric with the observed
+      trial-period uplift of the total, its band, p_value and the number of
+      pre-trial periods the bootstrap drew from (see the module docstring for
+      why few of them make the p-values coarse).
+    alternative is 'greater' (uplift), 'less' or 'two-sided'. The same seed
+    always gives the same bands and p-values.
+    """
+    rng = np.random.default_rng(seed)
+    monthly = trial_results.copy()
+    monthly['null_lower'] = np.nan
+    monthly['null_upper'] = np.nan
+    monthly['p_value'] = np.nan
+
+    positions = monthly.groupby(SERIES_KEYS, sort=False).indices
+    keys = list(positions)
+    summary_rows = []
+    for start in range(0, len(keys), CHUNK_SERIES):
+        chunk = keys[start:start + CHUNK_SERIES]
+        # Every series of a results frame covers the same months, in order
+        rows = np.array([positions[key] for key in chunk])
+        period = monthly['period'].to_numpy()[rows]
+        trial_values = monthly['trial_value'].to_numpy(dtype=float)[rows]
+        control_values = monthly['control_value'].to_numpy(dtype=float)[rows]
+
+        predicted = bootstrap_predictions(trial_values, control_values, period == 'pre', n_resamples, rng)
+        pre_periods = ((period == 'pre') & ~np.isnan(trial_values) & ~np.isnan(control_values)).sum(axis=1)
+        lower, upper = _percentile(predicted, percentiles, axis=-1)
+        flat_rows = rows.ravel()
+        monthly.loc[monthly.index[flat_rows], 'null_lower'] = lower.ravel()
+        monthly.loc[monthly.index[flat_rows], 'null_upper'] = upper.ravel()
+        monthly.loc[monthly.index[flat_rows], 'p_value'] = _p_values(
+            predicted, trial_values[..., None], alternative
+        ).ravel()
+
+        # Trial-period totals: sum the predicted months of each resample
+        in_trial = period == 'trial'
+        predicted_total = np.where(in_trial[..., None], predicted, 0).sum(axis=1)
+        observed_total = np.where(in_trial, trial_values, 0).sum(axis=1)
+        total_lower, total_median, total_upper = _percentile(
+            predicted_total, [percentiles[0], 50, percentiles[1]], axis=-1
+        )
+        total_p = _p_values(predicted_total, observed_total[:, None], alternative)
+        for i, (trial_store, metric) in enumerate(chunk):
+            summary_rows.append({
+                'TRIAL_STORE': trial_store,
+                'metric': metric,
+                'total_trial': observed_total[i],
+                'null_median': total_median[i],
+                'null_lower': total_lower[i],
+                'null_upper': total_upper[i],
+                'p_value': total_p[i],
+                'pre_trial_periods': int(pre_periods[i]),
+            })
+
+    return monthly, pd.DataFrame(summary_rows)
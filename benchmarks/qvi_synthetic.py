@@ -0,0 +1,218 @@
+"""
+Synthetic QVI-shaped raw data for benchmarking.
+
+Writes a QVI_transaction_data file (Excel serial dates, product names in the
+QVI_transaction_data style, including non-chip products, the PROD_QTY == 200
+outlier and a few duplicate rows) and a matching QVI_purchase_behaviour.csv
+with the LIFESTAGE x PREMIUM_CUSTOMER mix of the real customer file.
+
+    python benchmarks/qvi_synthetic.py --stores 272 --months 12 --rows 264836 --output-dir /tmp/qvi_raw
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Product names as they appear in QVI_transaction_data.xlsx (irregular spacing included)
+PRODUCT_NAMES = [
+    'Natural Chip        Compny SeaSalt175g',
+    'CCs Nacho Cheese    175g',
+    'Smiths Crinkle Cut  Chips Chicken 170g',
+    'Smiths Chip Thinly  S/Cream&Onion 175g',
+    'Kettle Tortilla ChpsHny&Jlpno Chili 150g',
+    'Old El Paso Salsa   Dip Tomato Mild 300g',
+    'Smiths Crinkle Chips Salt & Vinegar 330g',
+    'Grain Waves         Sweet Chilli 210g',
+    'Doritos Corn Chip Mexican Jalapeno 150g',
+    'Grain Waves Sour    Cream&Chives 210G',
+    'Kettle Sensations   Siracha Lime 150g',
+    'Twisties Cheese     270g',
+    'WW Crinkle Cut      Chicken 175g',
+    'Thins Chips Light&  Tangy 175g',
+    'CCs Original 175g',
+    'Burger Rings 220g',
+    'NCC Sour Cream &    Garden Chives 175g',
+    'Doritos Corn Chip Southern Chicken 150g',
+    'Cheezels Cheese Box 125g',
+    'Smiths Crinkle      Original 330g',
+    'Infzns Crn Crnchers Tangy Gcamole 110g',
+    'Kettle Sea Salt     And Vinegar 175g',
+    'Smiths Chip Thinly  Cut Original 175g',
+    'Kettle Original 175g',
+    'Red Rock Deli Thai  Chilli&Lime 150g',
+    'Pringles Sthrn FriedChicken 134g',
+    'Pringles Sweet&Spcy BBQ 134g',
+    'Red Rock Deli SR    Salsa & Mzzrlla 150g',
+    'Thins Chips         Originl saltd 175g',
+    'Red Rock Deli Sp    Salt & Truffle 150G',
+    'Smiths Thinly       Swt Chli&S/Cream175G',
+    'Kettle Chilli 175g',
+    'Doritos Mexicana    170g',
+    'Smiths Crinkle Cut  French OnionDip 150g',
+    'Natural ChipCo      Hony Soy Chckn175g',
+    'Dorito Corn Chp     Supreme 380g',
+    'Twisties Chicken270g',
+    'Smiths Thinly Cut   Roast Chicken 175g',
+    'Smiths Crinkle Cut  Tomato Salsa 150g',
+    'Cobs Popd Sea Salt  Chips 110g',
+    'Tostitos Splash Of  Lime 175g',
+    'Woolworths Mild     Salsa 300g',
+    'Snbts Whlgrn Crisps Cheddr&Mstrd 90g',
+    'GrnWves Plus Btroot & Chilli Jam 180g',
+    'Sunbites Whlegrn    Crisps Frch/Onin 90g',
+    'French Fries Potato Chips 175g',
+    'Infuzions Thai SweetChili PotatoMix 110g',
+    'Old El Paso Salsa   Dip Chnky Tom Ht300g',
+    'Woolworths Medium   Salsa 300g',
+    'Doritos Salsa       Medium 300g',
+    'Smiths Chip Thinly  CutSalt/Vinegr175g',
+]
+
+# Share of loyalty cards per (LIFESTAGE, PREMIUM_CUSTOMER) in QVI_purchase_behaviour.csv
+SEGMENT_MIX = {
+    ('MIDAGE SINGLES/COUPLES', 'Budget'): 0.0207,
+    ('MIDAGE SINGLES/COUPLES', 'Mainstream'): 0.0460,
+    ('MIDAGE SINGLES/COUPLES', 'Premium'): 0.0335,
+    ('NEW FAMILIES', 'Budget'): 0.0153,
+    ('NEW FAMILIES', 'Mainstream'): 0.0117,
+    ('NEW FAMILIES', 'Premium'): 0.0081,
+    ('OLDER FAMILIES', 'Budget'): 0.0644,
+    ('OLDER FAMILIES', 'Mainstream'): 0.0390,
+    ('OLDER FAMILIES', 'Premium'): 0.0313,
+    ('OLDER SINGLES/COUPLES', 'Budget'): 0.0679,
+    ('OLDER SINGLES/COUPLES', 'Mainstream'): 0.0679,
+    ('OLDER SINGLES/COUPLES', 'Premium'): 0.0654,
+    ('RETIREES', 'Budget'): 0.0613,
+    ('RETIREES', 'Mainstream'): 0.0892,
+    ('RETIREES', 'Premium'): 0.0533,
+    ('YOUNG FAMILIES', 'Budget'): 0.0553,
+    ('YOUNG FAMILIES', 'Mainstream'): 0.0376,
+    ('YOUNG FAMILIES', 'Premium'): 0.0335,
+    ('YOUNG SINGLES/COUPLES', 'Budget'): 0.0520,
+    ('YOUNG SINGLES/COUPLES', 'Mainstream'): 0.1113,
+    ('YOUNG SINGLES/COUPLES', 'Premium'): 0.0354,
+}
+
+# The real extract has ~3.6 transaction rows per loyalty card
+ROWS_PER_CARD = 3.6
+
+# Share of stores that miss some months (and are dropped by the 12-month filter in Task 2)
+PARTIAL_STORE_SHARE = 0.05
+
+START_MONTH = '2018-07'
+
+
+def _transaction_dates(n_months):
+    # Every trading day of n_months months from START_MONTH; Christmas Day has no sales
+    start = pd.Period(START_MONTH, freq='M')
+    dates = pd.date_range(start.start_time, (start + n_months - 1).end_time.normalize())
+    return dates[~((dates.month == 12) & (dates.day == 25))]
+
+
+def _excel_serial(dates):
+    return (dates - pd.Timestamp('1899-12-30')).days.to_numpy()
+
+
+def generate_qvi_data(n_stores=272, n_months=12, n_rows=264_836, seed=0):
+    """
+    Build synthetic (transactions, behaviour) frames with the raw QVI schemas.
+
+    Loyalty cards are numbered <store><3 digits> like the real ones, so each card
+    shops at one home store. A PARTIAL_STORE_SHARE of stores only trade for part
+    of the period. Returns the transaction rows in DATE order.
+    """
+    rng = np.random.default_rng(seed)
+    dates = _transaction_dates(n_months)
+
+    # Loyalty cards, assigned to stores and segments
+    n_cards = max(n_stores, int(n_rows / ROWS_PER_CARD))
+    card_store = np.sort(rng.integers(1, n_stores + 1, n_cards))
+    card_store[:n_stores] = np.arange(1, n_stores + 1)
+    card_store.sort()
+    card_rank = np.arange(n_cards) - np.searchsorted(card_store, card_store)
+    cards = card_store.astype(np.int64) * 1000 + card_rank
+
+    segments = list(SEGMENT_MIX)
+    mix = np.array(list(SEGMENT_MIX.values()))
+    segment = rng.choice(len(segments), n_cards, p=mix / mix.sum())
+    behaviour = pd.DataFrame({
+        'LYLTY_CARD_NBR': cards,
+        'LIFESTAGE': [segments[code][0] for code in segment],
+        'PREMIUM_CUSTOMER': [segments[code][1] for code in segment],
+    })
+
+    # Transactions: a card per row, dated within its store's trading period
+    row_card = rng.integers(0, n_cards, n_rows)
+    stores = card_store[row_card]
+    partial = rng.random(n_stores + 1) < PARTIAL_STORE_SHARE
+    last_day = np.where(partial[stores], rng.integers(len(dates) // 2, len(dates), n_rows), len(dates))
+    day = (rng.random(n_rows) * last_day).astype(np.int64)
+
+    products = np.array(PRODUCT_NAMES)
+    pack_size = pd.Series(products).str.extract(r'(\d+)[gG]', expand=False).astype(int).to_numpy()
+    unit_price = np.round(1.2 + pack_size * 0.012 + rng.random(len(products)), 1)
+    product = rng.integers(0, len(products), n_rows)
+    quantity = rng.choice([1, 2, 3, 4, 5], n_rows, p=[0.1, 0.85, 0.02, 0.02, 0.01])
+
+    transactions = pd.DataFrame({
+        'DATE': _excel_serial(dates[day]),
+        'STORE_NBR': stores,
+        'LYLTY_CARD_NBR': cards[row_card],
+        'TXN_ID': 0,
+        'PROD_NBR': product + 1,
+        'PROD_NAME': products[product],
+        'PROD_QTY': quantity,
+        'TOT_SALES': np.round(unit_price[product] * quantity, 1),
+    }).sort_values(['DATE', 'STORE_NBR'], kind='stable').reset_index(drop=True)
+    transactions['TXN_ID'] = np.arange(1, n_rows + 1)
+
+    # The commercial buyer with PROD_QTY == 200 and a few exact duplicate rows
+    outliers = transactions.sample(2, random_state=seed).assign(PROD_QTY=200)
+    outliers['TOT_SALES'] = 650.0
+    duplicates = transactions.sample(min(5, n_rows), random_state=seed + 1)
+    transactions = pd.concat([transactions, outliers, duplicates]).sort_values('DATE', kind='stable')
+    return transactions.reset_index(drop=True), behaviour
+
+
+def write_qvi_data(output_dir, n_stores=272, n_months=12, n_rows=264_836, seed=0, file_format='csv'):
+    """
+    Write QVI_transaction_data.<csv|xlsx> and QVI_purchase_behaviour.csv to output_dir.
+
+    file_format='xlsx' writes the workbook like the real extract (slow for large
+    n_rows); 'csv' writes the same columns as a CSV export.
+    Returns (transaction_path, behaviour_path).
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    transactions, behaviour = generate_qvi_data(n_stores, n_months, n_rows, seed)
+
+    transaction_path = output_dir / f'QVI_transaction_data.{file_format}'
+    if file_format == 'xlsx':
+        transactions.to_excel(transaction_path, index=False)
+    else:
+        transactions.to_csv(transaction_path, index=False)
+    behaviour_path = output_dir / 'QVI_purchase_behaviour.csv'
+    behaviour.to_csv(behaviour_path, index=False)
+    return transaction_path, behaviour_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic QVI-shaped raw data files.')
+    parser.add_argument('--stores', type=int, default=272)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--rows', type=int, default=264_836)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    parser.add_argument('--output-dir', required=True)
+    args = parser.parse_args()
+
+    paths = write_qvi_data(args.output_dir, args.stores, args.months, args.rows, args.seed, args.format)
+    for path in paths:
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Stage benchmarks for the Task 1 cleaning and Task 2 trial evaluation pipeline.
+
+Generates synthetic QVI-shaped data (see qvi_synthetic.py), runs every stage
+once per repeat in a fresh temporary directory and reports the wall time and
+peak RSS of each stage. Results are compared against a stored baseline:
+
+    python benchmarks/run_benchmarks.py                       # compare with benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --rows 2000000        # scale up
+    python benchmarks/run_benchmarks.py --save-baseline       # record a new baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')
+
+import pandas as pd
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(REPO_DIR / 'Task 1' / 'data analysis'))
+sys.path.append(str(REPO_DIR / 'Task 2'))
+
+from control_scoring import build_store_month_matrices  # noqa: E402
+from customer_dimension import CustomerDimension  # noqa: E402
+from instrumentation import peak_rss_mb, reset_peak_rss  # noqa: E402
+from merged_data import read_merged_data, write_merged_data  # noqa: E402
+from monthly_metrics_store import MonthlyMetricsStore  # noqa: E402
+from product_parser import attach_product_attributes  # noqa: E402
+from qvi_synthetic import write_qvi_data  # noqa: E402
+from trial_evaluation import compute_uplift, normalize_trials, render_trial_figures, select_controls  # noqa: E402
+from transaction_ingest import load_clean_transactions  # noqa: E402
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+STAGES = ['ingest', 'parse', 'merge', 'monthly_metrics', 'scoring', 'uplift', 'plotting']
+
+# A stage is flagged when it is this much slower than the baseline and the
+# difference is large enough not to be timer noise
+DEFAULT_TOLERANCE = 1.25
+MIN_REGRESSION_S = 0.05
+
+
+def _run_stage(name, timings, function, *args):
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args)
+    timings[name] = {'wall_s': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+    return result
+
+
+def _merge(transactions, behaviour_path, merged_path):
+    # Part 1 from the cleaned transactions to MergedData.csv
+    customers = CustomerDimension.from_csv(behaviour_path)
+    dates = pd.to_datetime(transactions['DATE'])
+    transactions = transactions.assign(
+        DATE=dates.dt.date, MONTH_YEAR=dates.dt.to_period('M'), YEAR=dates.dt.year, MONTH_NAME=dates.dt.month_name(),
+    )
+    transactions = transactions.sort_values('DATE').reset_index(drop=True)
+    merged = customers.attach(transactions)
+    write_merged_data(merged, merged_path)
+    return merged
+
+
+def _monthly_metrics(merged_path, state_dir):
+    # Task 2 data prep: incremental store-month metrics, stores with every month
+    data = read_merged_data(merged_path, columns=['STORE_NBR', 'MONTH_YEAR', 'TOT_SALES', 'LYLTY_CARD_NBR', 'TXN_ID'])
+    metrics_store = MonthlyMetricsStore(state_dir)
+    metrics_store.sync(data)
+    monthly_metrics = metrics_store.monthly_metrics()
+
+    n_months = monthly_metrics['MONTH_YEAR'].nunique()
+    store_month_counts = monthly_metrics.groupby('STORE_NBR')['MONTH_YEAR'].nunique()
+    valid_stores = store_month_counts[store_month_counts == n_months].index
+    return monthly_metrics[monthly_metrics['STORE_NBR'].isin(valid_stores)].reset_index(drop=True)
+
+
+def benchmark_trials(monthly_metrics, n_trials=3):
+    """
+    Trial stores and windows for the benchmark.
+
+    Uses stores 77, 86 and 88 when they are valid (the real trial stores),
+    otherwise the last valid stores. The pre-trial window covers the first 7
+    months and the trial window the next 3, like the real trial.
+    """
+    stores = monthly_metrics['STORE_NBR'].unique()
+    trial_stores = [store for store in (77, 86, 88) if store in stores][:n_trials]
+    if len(trial_stores) < n_trials:
+        trial_stores = list(stores[-n_trials:])
+
+    months = sorted(monthly_metrics['MONTH_YEAR'].unique())
+    pre_window = (months[0], months[min(6, len(months) - 1)])
+    trial_window = (months[min(7, len(months) - 1)], months[min(9, len(months) - 1)])
+    return normalize_trials([
+        {'store': int(store), 'pre_window': pre_window, 'trial_window': trial_window} for store in trial_stores
+    ])
+
+
+def _score(monthly_metrics, trials):
+    # Store-month matrices and the batched control selection
+    matrices = build_store_month_matrices(monthly_metrics)
+    return matrices, select_controls(matrices, trials)
+
+
+def run_pipeline(transaction_path, behaviour_path, work_dir):
+    # Run every stage once and return {stage: {'wall_s', 'peak_rss_mb'}}
+    work_dir = Path(work_dir)
+    merged_path = work_dir / 'MergedData.csv'
+    figure_dir = work_dir / 'visualizations'
+    figure_dir.mkdir()
+    timings = {}
+
+    transactions = _run_stage('ingest', timings, load_clean_transactions, transaction_path)
+    transactions = _run_stage('parse', timings, attach_product_attributes, transactions)
+    _run_stage('merge', timings, _merge, transactions, behaviour_path, merged_path)
+    monthly_metrics = _run_stage('monthly_metrics', timings, _monthly_metrics, merged_path, work_dir / 'state')
+
+    trials = benchmark_trials(monthly_metrics)
+    matrices, controls = _run_stage('scoring', timings, _score, monthly_metrics, trials)
+    results = _run_stage('uplift', timings, compute_uplift, matrices, trials, controls)
+    _run_stage('plotting', timings, render_trial_figures, results, figure_dir)
+    return timings
+
+
+def run_benchmarks(n_stores, n_months, n_rows, seed=0, file_format='csv', repeat=1):
+    """
+    Generate the synthetic data and run the pipeline repeat times.
+
+    Each stage reports its best wall time and largest peak RSS over the repeats.
+    Returns a JSON-serialisable report.
+    """
+    config = {'stores': n_stores, 'months': n_months, 'rows': n_rows, 'seed': seed, 'format': file_format}
+    stages = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        transaction_path, behaviour_path = write_qvi_data(data_dir, n_stores, n_months, n_rows, seed, file_format)
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                for stage, timing in run_pipeline(transaction_path, behaviour_path, work_dir).items():
+                    best = stages.setdefault(stage, timing)
+                    best['wall_s'] = min(best['wall_s'], timing['wall_s'])
+                    best['peak_rss_mb'] = max(best['peak_rss_mb'], timing['peak_rss_mb'])
+
+    return {
+        'config': config,
+        'environment': {
+            'python': platform.python_version(), 'pandas': pd.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': stages,
+        'total_wall_s': sum(timing['wall_s'] for timing in stages.values()),
+        'peak_rss_mb': max(timing['peak_rss_mb'] for timing in stages.values()),
+    }
+
+
+def compare_with_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print each stage next to its baseline and return the stages that regressed.
+
+    A stage regresses when its wall time exceeds tolerance x the baseline by
+    more than MIN_REGRESSION_S. The comparison is only meaningful for the same config, so a mismatch is reported.
+    """
+    if baseline['config'] != report['config']:
+        print(f"note: baseline config {baseline['config']} differs from this run {report['config']}")
+
+    regressions = []
+    print(f"{'stage':<16}{'wall s':>10}{'baseline':>10}{'ratio':>8}{'peak MB':>10}{'baseline':>10}")
+    for stage in STAGES:
+        current, previous = report['stages'][stage], baseline['stages'].get(stage)
+        if previous is None:
+            print(f"{stage:<16}{current['wall_s']:>10.3f}{'-':>10}{'-':>8}{current['peak_rss_mb']:>10.1f}{'-':>10}")
+            continue
+        ratio = current['wall_s'] / previous['wall_s'] if previous['wall_s'] else float('inf')
+        slower = ratio > tolerance and current['wall_s'] - previous['wall_s'] > MIN_REGRESSION_S
+        flag = '  <-- slower' if slower else ''
+        print(f"{stage:<16}{current['wall_s']:>10.3f}{previous['wall_s']:>10.3f}{ratio:>8.2f}"
+              f"{current['peak_rss_mb']:>10.1f}{previous['peak_rss_mb']:>10.1f}{flag}")
+        if slower:
+            regressions.append(stage)
+    print(f"{'total':<16}{report['total_wall_s']:>10.3f}{baseline['total_wall_s']:>10.3f}"
+          f"{report['total_wall_s'] / baseline['total_wall_s']:>8.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the QVI pipeline stages on synthetic data.')
+    parser.add_argument('--stores', type=int, default=272)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--rows', type=int, default=264_836)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv',
+                        help='raw transaction file format; xlsx includes the workbook parsing cost')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best wall time is kept')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--output', type=Path, help='also write the JSON report here')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.stores, args.months, args.rows, args.seed, args.format, args.repeat)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + '\n')
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2) + '\n')
+        print(f'baseline written to {args.baseline}')
+    elif args.baseline.exists():
+        regressions = compare_with_baseline(report, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print(f"regressed stages: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()